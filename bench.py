@@ -0,0 +1,358 @@
+import os
+# 計測中の進捗バーは出さない (tqdm は import 時にこの環境変数を読む)
+os.environ.setdefault('TQDM_DISABLE', '1')
+
+import sys
+import copy
+import json
+import math
+import time
+import zlib
+import random
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+import numpy as np
+from typing import Dict, List, Callable
+import config
+from src import utils, analyze_run, resultio, ann
+from src.evaluation import Evaluator
+from src.prompts import PromptManager
+from src.searcher import SparseSearcher
+
+
+logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(message)s', force=True)
+
+# 規模ごとのコーパスサイズ (文書数, クエリ数, クエリあたりのヒット数)
+SCALES = {
+    'tiny': (500, 8, 20),
+    'small': (4000, 32, 50),
+    'medium': (20000, 128, 100),
+}
+GEN_KEY = 'gen_cand_stub'
+DOC_GEN = 5
+
+
+# ---------------------------------------------------------------------------
+# 合成データ
+# ---------------------------------------------------------------------------
+def make_vocab(size: int, rng: random.Random) -> List[str]:
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(letters) for _ in range(rng.randint(3, 9))))
+    return sorted(words)
+
+
+def make_corpus(n_docs: int, n_queries: int, seed: int = 0):
+    """
+    Zipf 風の単語分布を持つ合成コーパスとクエリ・qrels を作る。
+    各クエリは「トピック語」を持ち、そのトピック語を含む文書を関連文書 (rel 1-2) とする。
+    """
+    rng = random.Random(seed)
+    vocab = make_vocab(5000, rng)
+    weights = [1.0 / (rank + 1) for rank in range(len(vocab))]
+    topic_words = rng.sample(vocab[500:], n_queries * 3)
+
+    docs = {}
+    for i in range(n_docs):
+        words = rng.choices(vocab, weights=weights, k=rng.randint(40, 160))
+        docs[f"D{i}"] = ' '.join(words)
+
+    topics, qrels = {}, {}
+    doc_ids = list(docs)
+    for q in range(n_queries):
+        qid = str(1000 + q)
+        terms = topic_words[q * 3:(q + 1) * 3]
+        topics[qid] = {'title': ' '.join(terms + rng.choices(vocab[:500], k=2))}
+        relevant = rng.sample(doc_ids, 12)
+        for docid in relevant:
+            docs[docid] += ' ' + ' '.join(rng.choices(terms, k=rng.randint(2, 6)))
+        qrels[qid] = {docid: rng.randint(1, 2) for docid in relevant}
+        for docid in rng.sample(doc_ids, 20):
+            qrels[qid].setdefault(docid, 0)
+    return vocab, docs, topics, qrels
+
+
+class _Hit:
+    __slots__ = ('docid', 'score')
+
+    def __init__(self, docid, score):
+        self.docid = docid
+        self.score = score
+
+
+class _Doc:
+    def __init__(self, text):
+        self._raw = json.dumps({'contents': text})
+
+    def raw(self):
+        return self._raw
+
+
+class StubSearcher:
+    """LuceneSearcher と同じインタフェースを持つ、メモリ上の簡易 BM25 (pyserini のインデックス不要)。"""
+
+    def __init__(self, docs: Dict[str, str], k1: float = 0.9, b: float = 0.4):
+        self.docs = docs
+        self.k1, self.b = k1, b
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.lengths = {}
+        for docid, text in docs.items():
+            terms = text.split()
+            self.lengths[docid] = len(terms)
+            for term in terms:
+                tf = self.postings.setdefault(term, {})
+                tf[docid] = tf.get(docid, 0) + 1
+        self.avgdl = sum(self.lengths.values()) / max(1, len(self.lengths))
+
+    def search(self, query: str, k: int = 10):
+        scores = {}
+        n = len(self.docs)
+        for term in query.lower().split():
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for docid, tf in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[docid] / self.avgdl)
+                scores[docid] = scores.get(docid, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda x: (-x[1], x[0]))[:k]
+        # Lucene と同じく float32 のスコアを返す
+        return [_Hit(docid, float(np.float32(score))) for docid, score in ranked]
+
+    def batch_search(self, queries, qids, k=10, threads=1):
+        return {qid: self.search(q, k) for qid, q in zip(qids, queries)}
+
+    def doc(self, docid):
+        return _Doc(self.docs[docid]) if docid in self.docs else None
+
+    def batch_doc(self, docids, threads=1):
+        return {d: self.doc(d) for d in docids}
+
+
+class StubGenerator:
+    """LLMGenerator の代わりに、クエリから決定的に疑似参照文を作る (API 呼び出しなし)。"""
+
+    def __init__(self, vocab: List[str], length: int = 60):
+        self.vocab = vocab
+        self.length = length
+
+    def _sample(self, query: str, idx: int) -> str:
+        rng = random.Random(zlib.crc32(f"{query}\t{idx}".encode()))
+        words = query.split() * 2 + rng.choices(self.vocab, k=self.length)
+        rng.shuffle(words)
+        return ' '.join(words)
+
+    def generate_many(self, requests, n, desc="Generating"):
+        return [[self._sample(query, i) for i in range(n)] for _, query in requests]
+
+
+def build_tiny_encoder(path: str, vocab: List[str], seed: int = 0):
+    """乱数初期化した小さな BERT (2層, 64次元) とトークナイザを path に保存する。"""
+    import torch
+    from transformers import BertConfig, BertModel, BertTokenizerFast
+
+    vocab_file = os.path.join(path, 'vocab.txt')
+    with open(vocab_file, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + vocab) + '\n')
+    tokenizer = BertTokenizerFast(vocab_file=vocab_file, do_lower_case=True, model_max_length=512)
+    tokenizer.save_pretrained(path)
+
+    torch.manual_seed(seed)
+    model = BertModel(BertConfig(
+        vocab_size=len(vocab) + 5, hidden_size=64, num_hidden_layers=2, num_attention_heads=2,
+        intermediate_size=128, max_position_embeddings=512
+    ))
+    model.save_pretrained(path)
+
+
+# ---------------------------------------------------------------------------
+# 計測
+# ---------------------------------------------------------------------------
+def measure(fn: Callable, items: int, repeats: int, warmup: int = 1) -> Dict[str, float]:
+    """fn を warmup 回空回ししてから repeats 回計測し、所要時間とスループットの統計を返す。"""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    rates = [items / t for t in times if t > 0]
+    return {
+        'items': items,
+        'repeats': repeats,
+        'mean_sec': statistics.mean(times),
+        'std_sec': statistics.stdev(times) if len(times) > 1 else 0.0,
+        'min_sec': min(times),
+        'p50_sec': statistics.median(times),
+        'items_per_sec': statistics.mean(rates) if rates else 0.0,
+        'items_per_sec_std': statistics.stdev(rates) if len(rates) > 1 else 0.0,
+    }
+
+
+def build_suite(scale: str, workdir: str, seed: int = 0, bm25_threads: int = 1) -> Dict[str, tuple]:
+    """{component: (計測する関数, 1回あたりの件数, 単位)} を作る。"""
+    n_docs, n_queries, n_hits = SCALES[scale]
+    vocab, docs, topics, qrels = make_corpus(n_docs, n_queries, seed)
+    searcher = StubSearcher(docs)
+    generator = StubGenerator(vocab)
+
+    args = config.parse_args([])
+    args.topk = n_hits
+    args.bm25_threads = bm25_threads
+    args.article_num = DOC_GEN
+
+    with_refs = copy.deepcopy(topics)
+    SparseSearcher.add_pseudo_docs(with_refs, generator, PromptManager, GEN_KEY, DOC_GEN)
+    bm25_results = SparseSearcher.bm25_search(args, copy.deepcopy(with_refs), searcher, qrels, GEN_KEY)
+    doc_texts = [text for item in bm25_results for text in item.contents()]
+
+    # 評価系の入力ファイル
+    qrels_path = os.path.join(workdir, 'qrels.txt')
+    with open(qrels_path, 'w', encoding='utf-8') as f:
+        for qid, rels in qrels.items():
+            f.writelines(f"{qid} 0 {docid} {rel}\n" for docid, rel in rels.items())
+    ranked = {item.qid: list(zip(item.docids(), item.scores.tolist())) for item in bm25_results}
+    run_path = os.path.join(workdir, 'bm25.run')
+    with utils.RunWriter(run_path) as writer:
+        for qid, hits in ranked.items():
+            writer.write(qid, hits)
+    json_path = os.path.join(workdir, 'bm25.json')
+    utils.dump_json(utils.normalize_rerank_to_bm25_json(ranked, bm25_results, topk=n_hits), json_path)
+    jsonl_path = os.path.join(workdir, 'bm25.jsonl.gz')
+    resultio.convert_legacy(json_path, jsonl_path)
+
+    suite = {
+        'add_pseudo_docs': (lambda: SparseSearcher.add_pseudo_docs(copy.deepcopy(topics), generator, PromptManager,
+                                                                   GEN_KEY, DOC_GEN), n_queries, 'queries'),
+        'bm25_search': (lambda: SparseSearcher.bm25_search(args, copy.deepcopy(with_refs), searcher, qrels, GEN_KEY),
+                        n_queries, 'queries'),
+        'normalize_rerank_to_bm25_json': (lambda: utils.normalize_rerank_to_bm25_json(ranked, bm25_results, topk=10),
+                                          n_queries, 'queries'),
+        'convert_json_to_run': (lambda: utils.convert_json_to_run(json_path, os.path.join(workdir, 'conv.run'), 'bench'),
+                                n_queries, 'queries'),
+        'convert_jsonl_to_run': (lambda: utils.convert_json_to_run(jsonl_path, os.path.join(workdir, 'conv.run'), 'bench'),
+                                 n_queries, 'queries'),
+        'analyze_run': (lambda: analyze_run.eval_run(analyze_run.load_qrels(qrels_path),
+                                                     analyze_run.load_run(run_path), 10), n_queries, 'queries'),
+        'evaluate': (lambda: Evaluator.evaluate(run_path, qrels_path, metrics=('ndcg_cut.10', 'map', 'recall.100')),
+                     n_queries, 'queries'),
+    }
+
+    # IVF 索引 (--irmode mugidense) は正規化した乱数ベクトルで測る
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((n_docs, 64), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    ivf_path = os.path.join(workdir, 'ivf')
+    ivf = ann.IVFIndex.build(ivf_path, vectors)
+    query_vectors = vectors[rng.choice(n_docs, n_queries, replace=False)]
+    suite.update({
+        'ann_build': (lambda: ann.IVFIndex.build(ivf_path + '-bench', vectors), n_docs, 'vectors'),
+        'ann_search': (lambda: ivf.search(query_vectors, k=n_hits, nprobe=8), n_queries, 'queries'),
+    })
+
+    try:
+        import torch
+        from src.retriever import NeuralRetriever
+    except ImportError as e:
+        logging.warning(f"Skipping encoder benchmarks ({e})")
+        return suite
+    model_dir = os.path.join(workdir, 'tiny-encoder')
+    os.makedirs(model_dir, exist_ok=True)
+    build_tiny_encoder(model_dir, vocab, seed)
+    retriever = NeuralRetriever(model_dir, mode='contex-pool')
+    retriever.device = 'cpu'
+    retriever.model.to('cpu')
+    embed_batch = doc_texts[:32]
+    suite.update({
+        'embed': (lambda: retriever.embed(embed_batch), len(embed_batch), 'texts'),
+        'embed_many': (lambda: retriever.embed_many(doc_texts), len(doc_texts), 'texts'),
+        'rerank': (lambda: retriever.rerank(bm25_results, GEN_KEY, topk=n_hits, use_enhanced_query=True),
+                   n_queries, 'queries'),
+    })
+    return suite
+
+
+def compare(results: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """ベースラインよりスループットが threshold 以上落ちたコンポーネントを返す。"""
+    regressions = []
+    for name, res in results.items():
+        base = baseline.get('components', {}).get(name)
+        if not base or not base['items_per_sec']:
+            continue
+        ratio = res['items_per_sec'] / base['items_per_sec']
+        res['vs_baseline'] = ratio
+        if ratio < 1.0 - threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gen-QER: offline CPU benchmark of the retrieval pipeline components")
+    parser.add_argument('--scale', choices=list(SCALES), default='small')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='*', default=None, help='Run only these components')
+    parser.add_argument('--torch_threads', type=int, default=1, help='Fixed intra-op threads for reproducible timings')
+    parser.add_argument('--baseline', type=str, default='results/bench_baseline.json')
+    parser.add_argument('--save_baseline', action='store_true', help='Overwrite the baseline with this run')
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help='Flag a regression when throughput drops by more than this fraction')
+    parser.add_argument('--output', type=str, default=None, help='Also write the full report JSON here')
+    args = parser.parse_args()
+
+    try:
+        import torch
+        torch.set_num_threads(args.torch_threads)
+        torch.manual_seed(args.seed)
+    except ImportError:
+        pass
+
+    env = {
+        'scale': args.scale, 'seed': args.seed, 'torch_threads': args.torch_threads,
+        'python': platform.python_version(), 'machine': platform.machine(), 'processor': platform.processor(),
+    }
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='genqer-bench-') as workdir:
+        suite = build_suite(args.scale, workdir, args.seed)
+        for name, (fn, items, unit) in suite.items():
+            if args.only and name not in args.only:
+                continue
+            results[name] = dict(measure(fn, items, args.repeats), unit=unit)
+
+    baseline = utils.load_json(args.baseline) if os.path.exists(args.baseline) else {}
+    regressions = []
+    if baseline and baseline.get('env', {}).get('scale') == args.scale:
+        regressions = compare(results, baseline, args.threshold)
+    elif baseline:
+        print(f"⚠️ Baseline was recorded at scale={baseline.get('env', {}).get('scale')}; skipping comparison")
+
+    print(f"\n=== ⏱️ BENCHMARK ({args.scale}, {args.repeats} repeats) ===")
+    print(f"{'component':32s} {'throughput':>30s} {'mean latency':>16s} {'vs baseline':>12s}")
+    for name, res in results.items():
+        rate = f"{res['items_per_sec']:.1f} ± {res['items_per_sec_std']:.1f} {res['unit']}/s"
+        latency = f"{res['mean_sec'] * 1000:.1f} ± {res['std_sec'] * 1000:.1f} ms"
+        ratio = f"{res['vs_baseline']:.2f}x" if 'vs_baseline' in res else '-'
+        flag = '  ❌ REGRESSION' if name in regressions else ''
+        print(f"{name:32s} {rate:>30s} {latency:>16s} {ratio:>12s}{flag}")
+
+    report = {'env': env, 'created': time.time(), 'components': results}
+    if args.output:
+        utils.dump_json(report, args.output)
+    if args.save_baseline:
+        if baseline.get('env', {}).get('scale') == args.scale:
+            # --only で一部だけ測った場合も他のコンポーネントのベースラインは残す
+            report['components'] = dict(baseline.get('components', {}), **results)
+        utils.dump_json(report, args.baseline)
+        print(f"💾 Saved baseline: {args.baseline}")
+    if regressions:
+        print(f"❌ Regressions (> {args.threshold:.0%} slower): {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
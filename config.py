@@ -1,27 +1,66 @@
 import argparse
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description="Gen-QER: Query Expansion & Reranking")
 
     parser.add_argument('--irmode', type=str, default='mugipipeline',
-                        choices=['mugisparse','rerank','mugirerank','mugipipeline'],
-                        help='Information retrieval mode')
+                        choices=['mugisparse','rerank','mugirerank','mugipipeline','mugidense'],
+                        help='Information retrieval mode (mugidense: full-corpus dense retrieval over an IVF index)')
     
     # Document Generation Settings
     parser.add_argument('--llm', type=str, default='gpt-4o', help='Pseudo reference generation model (gpt, 01-ai, Qwen, etc.)')
     parser.add_argument('--doc_gen', type=int, default=5, help='Number of generated documents (n)')
     parser.add_argument('--output_path', type=str, default='./exp', help='Output directory path')
+    parser.add_argument('--gen_cache', type=str, default='./exp/cache/generations.sqlite',
+                        help='SQLite cache of generated pseudo-docs keyed by (model, prompt, query, sample)')
+    parser.add_argument('--no_gen_cache', action='store_true', help='Disable the generation cache')
+    parser.add_argument('--gen_workers', type=int, default=8, help='Concurrent OpenAI generation requests')
+    parser.add_argument('--tpm_limit', type=int, default=None, help='OpenAI tokens-per-minute budget (None = unlimited)')
+    parser.add_argument('--gen_batch_size', type=int, default=16, help='Max sequences per local-LLM generate call')
+    parser.add_argument('--no_prefix_cache', action='store_true', help='Disable the KV cache of the shared prompt prefix (local LLMs)')
+    parser.add_argument('--openai_base_url', type=str, default=None, help='OpenAI-compatible endpoint (e.g. local stub server)')
     
     # Sparse Retrieval (BM25) Settings
     parser.add_argument('--repeat_times', '-t', default=None, type=int, help='Fixed repetition times for query expansion')
     parser.add_argument('--adaptive_times', '-at', default=6, type=int, help='Adaptive repetition factor')
     parser.add_argument('--topk', type=int, default=100, help='BM25 retrieved top-k documents')
     parser.add_argument('--article_num','-a', default=5, type=int, help='Number of pseudo-docs used for sparse expansion')
+    parser.add_argument('--expansion', type=str, choices=['repeat', 'weighted'], default='repeat',
+                        help='repeat: repeated query string (original); weighted: one boosted term query with the same weights')
+    parser.add_argument('--max_terms', type=int, default=0,
+                        help='Keep only the top-N weighted expansion terms (0 = all; weighted expansion only)')
+    parser.add_argument('--doc_cache', type=str, default='./exp/cache/docs.sqlite',
+                        help='On-disk cache of normalized document text')
+    parser.add_argument('--no_doc_cache', action='store_true', help='Keep the document text cache in memory only')
+    parser.add_argument('--journal', type=str, default='./exp/cache/journal.sqlite',
+                        help='Per-query checkpoint journal of BM25/rerank outputs (keyed by dataset and stage config)')
+    parser.add_argument('--no_journal', action='store_true', help='Do not journal or resume per-query stage outputs')
+    parser.add_argument('--fresh', action='store_true', help='Discard journaled outputs for this config and start over')
+    parser.add_argument('--doc_cache_size', type=int, default=200000, help='Max documents kept in the in-memory LRU cache')
+    parser.add_argument('--bm25_threads', type=int, default=8, help='Threads for Lucene batch search and document fetches (1 = sequential)')
     
     # Dense Retrieval / Reranking Settings
     parser.add_argument('--rank_model', type=str, default='sentence-transformers/all-mpnet-base-v2',
                         help='HuggingFace model name for dense retrieval/reranking')
     parser.add_argument('--dense_topk', type=int, default=100, help='Number of documents to rerank')
+    parser.add_argument('--cascade_model', type=str, default=None,
+                        help='Cheap encoder that scores all --dense_topk candidates first; only its top --cascade_m '
+                             'are re-encoded by --rank_model (e.g. sentence-transformers/all-MiniLM-L6-v2, default: off)')
+    parser.add_argument('--cascade_m', type=int, default=20, help='Candidates per query passed to --rank_model in the cascade (>= 1)')
+    parser.add_argument('--emb_cache', type=str, default='./exp/cache/embeddings',
+                        help='Directory of memory-mapped embeddings keyed by (rank_model, index, docid) '
+                             'and (rank_model, query text hash)')
+    parser.add_argument('--no_emb_cache', action='store_true', help='Disable the document and query embedding caches')
+    parser.add_argument('--ann_nlist', type=int, default=0,
+                        help='IVF lists for --irmode mugidense (0 = 4 * sqrt(corpus size))')
+    parser.add_argument('--ann_nprobe', type=int, default=32, help='IVF lists scanned per query (>= nlist = exact search)')
+    parser.add_argument('--corpus_chunk', type=int, default=4096, help='Documents per chunk when encoding a whole corpus')
+    parser.add_argument('--inference', type=str, default='fp32', choices=['fp32', 'int8', 'bf16', 'compile'],
+                        help='Encoder inference backend (int8 dynamic quantization, bf16 autocast, torch.compile)')
+    parser.add_argument('--check_drift', type=int, default=0,
+                        help='Compare --inference against fp32 on this many queries per dataset (0 = off)')
+    parser.add_argument('--max_batch_tokens', type=int, default=16384,
+                        help='Token budget (max length x batch size) per encoder batch')
     
     # contex-pool を追加
     parser.add_argument('--mode', type=str, 
@@ -29,6 +68,29 @@ def parse_args():
                         default='contex-pool',
                         help='Query enhancement mode. Use "contex-pool" for best performance.')
     
+    parser.add_argument('--result_format', type=str, choices=['jsonl', 'jsonl.gz', 'jsonl.zst', 'json'], default='jsonl.gz',
+                        help='Per-query result file under {output_path} (json = legacy indent=4 file)')
+    parser.add_argument('--no_result_text', action='store_true',
+                        help='Do not store document text in result files (readers resolve docids from the index)')
+    parser.add_argument('--ledger', type=str, default='results/ledger.sqlite',
+                        help='Append-only results ledger (results/{irmode}.json is rebuilt from it)')
+    parser.add_argument('--evaluator', type=str, choices=['native', 'trec_eval'], default='native',
+                        help='In-process evaluator or the trec_eval jar (both use -c semantics)')
+    
+    # Pipeline Settings
+    parser.add_argument('--search_workers', type=int, default=1, help='Datasets generated/BM25-searched concurrently')
+    parser.add_argument('--rerank_workers', type=int, default=1, help='Datasets reranked/evaluated concurrently')
+    parser.add_argument('--queue_size', type=int, default=2, help='Max searched datasets waiting for reranking')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='Split each topic set across N worker processes (each with its own searcher/encoder)')
+    parser.add_argument('--shard_retries', type=int, default=2, help='Times a failed shard is resubmitted')
+    
+    parser.add_argument('--profile', action='store_true',
+                        help='Write a Chrome-trace profile (stage timings, latencies, batch stats) to {output_path}/profiles/')
+    parser.add_argument('--run_suffix', type=str, default='', help='Suffix appended to run/JSON file names')
     parser.add_argument('--test', action='store_true', help='Run in fast test mode (fewer queries)')
     
-    return parser.parse_args()
\ No newline at end of file
+    args = parser.parse_args(argv)
+    if args.cascade_m < 1:
+        parser.error('--cascade_m must be >= 1')
+    return args
\ No newline at end of file
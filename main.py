@@ -1,11 +1,14 @@
 import os
+import time
+import queue
 import logging
-from src import utils, benchmark
-from src.retriever import NeuralRetriever
+import threading
+from src import utils, benchmark, resultio, docstore, journal
 from src.prompts import PromptManager
-from src.generator import LLMGenerator
 from src.searcher import SparseSearcher
 from src.evaluation import Evaluator
+from src.ledger import ResultsLedger
+from src.profiler import PROFILER
 import config
 
 
@@ -13,102 +16,318 @@ logging.getLogger('httpx').setLevel(logging.WARNING)
 logging.getLogger('httpcore').setLevel(logging.WARNING)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s',force=True)
 
+
 def main(args):
-    # 1. モデル初期化
-    logging.info(f"Initializing Retriever: {args.rank_model} (Mode: {args.mode})")
-    retriever = NeuralRetriever(model_name=args.rank_model, mode=args.mode)
+    if args.profile:
+        PROFILER.enable()
+    if args.result_format.endswith('.zst') and resultio.zstandard is None:
+        logging.error("--result_format jsonl.zst requires the zstandard package")
+        return
+
+    # データセット
+    data_list = ['dl20', 'dl19', 'covid', 'nfc' ,'touche', 'dbpedia', 'scifact', 'signal', 'news', 'robust04'] #data_list = ['dl20', 'dl19', 'covid', 'nfc' ,'touche', 'dbpedia', 'scifact', 'signal', 'news', 'robust04']
+
+    if args.shards > 1:
+        # モデルは各ワーカープロセスが持つので、ここでは初期化しない
+        with PROFILER.span('pipeline', datasets=len(data_list), shards=args.shards):
+            run_sharded(args, data_list)
+        save_profile(args)
+        return
+
+    # 1. モデル初期化 (torch / transformers / openai はそのステージを使うときだけ読み込む)
+    retriever, reference = None, None
+    if args.irmode in ['mugirerank', 'mugipipeline', 'mugidense']:
+        from src.retriever import NeuralRetriever
+        logging.info(f"Initializing Retriever: {args.rank_model} (Mode: {args.mode})")
+        retriever = NeuralRetriever(
+            model_name=args.rank_model, mode=args.mode,
+            emb_cache=None if args.no_emb_cache else args.emb_cache,
+            max_batch_tokens=args.max_batch_tokens,
+            inference=args.inference
+        )
+        # 低精度バックエンドの精度チェック用の fp32 モデル
+        if args.check_drift > 0 and args.inference != 'fp32':
+            reference = NeuralRetriever(model_name=args.rank_model, mode=args.mode, max_batch_tokens=args.max_batch_tokens)
+        if args.cascade_model and args.irmode != 'mugidense':
+            from src.retriever import CascadeRetriever
+            logging.info(f"Initializing cascade: {args.cascade_model} -> {args.rank_model} (top-{args.cascade_m})")
+            retriever = CascadeRetriever(build_cascade_first(args), retriever, args.cascade_m)
     generator = None
     if args.doc_gen > 0:
         try:
-            generator = LLMGenerator(args.llm)
+            from src.generator import LLMGenerator
+            generator = LLMGenerator(
+                args.llm,
+                cache_path=None if args.no_gen_cache else args.gen_cache,
+                workers=args.gen_workers,
+                tokens_per_minute=args.tpm_limit,
+                base_url=args.openai_base_url,
+                batch_size=args.gen_batch_size,
+                prefix_cache=not args.no_prefix_cache
+            )
         except Exception as e:
             logging.error(f"Failed to initialize LLM: {e}")
             return
 
-    # データセット
-    data_list = ['dl20', 'dl19', 'covid', 'nfc' ,'touche', 'dbpedia', 'scifact', 'signal', 'news', 'robust04'] #data_list = ['dl20', 'dl19', 'covid', 'nfc' ,'touche', 'dbpedia', 'scifact', 'signal', 'news', 'robust04']
+    with PROFILER.span('pipeline', datasets=len(data_list)):
+        run_pipeline(args, data_list, generator, retriever, reference)
+    save_profile(args)
 
-    for dataset in data_list:
-        logging.info(f"#" * 30)
-        logging.info(f"Processing Dataset: {dataset}")
-        logging.info(f"#" * 30)
-        
-        # 2. Sparse Retrieval & Psued Reference Generation
-        try:
+
+def build_cascade_first(args):
+    """--cascade_model: 全候補をスコアリングする軽いエンコーダ (埋め込みキャッシュはモデルごとに分かれる)。"""
+    from src.retriever import NeuralRetriever
+    return NeuralRetriever(
+        model_name=args.cascade_model, mode=args.mode,
+        emb_cache=None if args.no_emb_cache else args.emb_cache,
+        max_batch_tokens=args.max_batch_tokens,
+        inference=args.inference
+    )
+
+
+def rank_model_label(args):
+    """台帳と集計ビューでのモデル名。カスケードは単独の --rank_model と区別する。"""
+    if args.cascade_model and args.irmode != 'mugidense':
+        return f"{args.cascade_model}>{args.rank_model}@{args.cascade_m}"
+    return args.rank_model
+
+
+def save_profile(args):
+    if not PROFILER.enabled:
+        return
+    profile_path = os.path.join(args.output_path, 'profiles',
+                                f"{args.irmode}_{args.llm}_{args.mode}_n{args.doc_gen}{args.run_suffix}.trace.json")
+    PROFILER.save(profile_path)
+    logging.info(f"⏱️ Saved profile to: {profile_path}")
+
+
+def search_dataset(dataset, generator, args, retriever=None):
+    """Stage 1: 疑似参照文の生成 + BM25 検索 (mugidense では密ベクトル検索)。失敗時は None を返す。"""
+    logging.info(f"#" * 30)
+    logging.info(f"Processing Dataset: {dataset}")
+    logging.info(f"#" * 30)
+    
+    # 2. Sparse Retrieval & Psued Reference Generation
+    try:
+        if args.fresh:
+            journal.discard_dataset(args, dataset)
+        with PROFILER.span('search_dataset', dataset=dataset):
             bm25_results = SparseSearcher.get_results_with_generation(
-                dataset=dataset, generator=generator, prompt_manager=PromptManager, args=args
+                dataset=dataset, generator=generator, prompt_manager=PromptManager, args=args, retriever=retriever
             )
-        except Exception as e:
-            logging.error(f"Error in Sparse Search for {dataset}: {e}")
-            continue
+    except Exception as e:
+        logging.error(f"Error in Sparse Search for {dataset}: {e}")
+        return None
+
+    if not bm25_results:
+        logging.warning(f"No results found for {dataset}. Skipping.")
+        return None
+    return bm25_results
 
-        if not bm25_results:
-            logging.warning(f"No results found for {dataset}. Skipping.")
-            continue
 
-        # 3. Reranking
-        if args.irmode in ['mugirerank', 'mugipipeline']:
+def rerank_dataset(dataset, bm25_results, retriever, args, reference=None, timings=None, rerank_result=None):
+    """
+    Stage 2: 密ベクトルでのリランキング + 保存 + 評価。
+    rerank_result (シャードで計算済みの {qid: [(docid, score), ...]}) を渡すとリランキングは省略する。
+    """
+    with PROFILER.span('rerank_dataset', dataset=dataset):
+        _rerank_dataset(dataset, bm25_results, retriever, args, reference, timings, rerank_result)
+
+
+def _rerank_dataset(dataset, bm25_results, retriever, args, reference=None, timings=None, rerank_result=None):
+    start = time.perf_counter()
+    cascade_stats = {}
+    if args.irmode == 'mugidense' and rerank_result is None:
+        # 第1段が密ベクトル検索なので、その順位をそのまま最終結果にする
+        rerank_result = {item.qid: list(zip(item.docids(), item.scores.tolist())) for item in bm25_results if item.qid}
+    # 3. Reranking
+    if args.irmode in ['mugirerank', 'mugipipeline', 'mugidense']:
+        if args.irmode == 'mugidense':
+            logging.info(f"Writing dense retrieval results... (Top-K: {args.topk})")
+        else:
             logging.info(f"Starting Dense Reranking... (Top-K: {args.dense_topk})")
-            
-            # 生成文のキー名 (ex: gen_cand_gpt4)
-            gen_key = f'gen_cand_{args.llm}' if 'gpt' not in args.llm else 'gen_cand_gpt4'
-            
-            # Rerank実行
-            rerank_result = retriever.rerank(
-                bm25_results, 
-                gen_key, 
-                topk=args.dense_topk, 
-                use_enhanced_query=True
+        
+        # 生成文のキー名 (ex: gen_cand_gpt4)
+        gen_key = SparseSearcher.gen_key_for(args.llm)
+        
+        if reference is not None:
+            from src.retriever import check_inference_drift
+            # カスケードでは最終段 (--rank_model) のバックエンドを比べる
+            report = check_inference_drift(
+                getattr(retriever, 'final', retriever), reference, bm25_results, gen_key, Evaluator.get_qrels_path(dataset),
+                n_queries=args.check_drift, topk=args.dense_topk
             )
+            logging.info(f"🔬 {args.inference} vs fp32 on {dataset}: {report}")
 
-            # 4. JSONの保存 (結果 + 疑似参照文)
-            rerank_json = utils.normalize_rerank_to_bm25_json(rerank_result, bm25_results)
-            
-            # 保存
-            run_tag = f"{dataset}_{args.llm}_{args.mode}_n{args.doc_gen}"
-            json_path = os.path.join(args.output_path, args.llm, f"{run_tag}.json")
-            
-            logging.info(f"💾 Saving JSON to: {json_path}")
-            utils.dump_json(rerank_json, json_path)
+        # 密ベクトル検索の結果は BM25 + rerank の RUN / 結果ファイルと別名にする
+        dense_tag = '_dense' if args.irmode == 'mugidense' else ''
+        run_tag = f"{dataset}_{args.llm}_{args.mode}_n{args.doc_gen}{dense_tag}{args.run_suffix}"
+        run_dir = os.path.join("results", "runs", args.llm)
+        run_path = os.path.join(run_dir, f"{run_tag}.run")
 
-            # 5. TREC RUN形式への変換
-            run_dir = os.path.join("results", "runs", args.llm)
-            run_path = os.path.join(run_dir, f"{run_tag}.run")
-            
-            logging.info(f"🔄 Converting to RUN format: {run_path}")
-            utils.convert_json_to_run(json_path, run_path, dataset)
+        # Rerank実行 (TREC RUN形式はクエリごとに密スコアで直接書き出す)
+        logging.info(f"🔄 Writing RUN file: {run_path}")
+        with utils.RunWriter(run_path) as run_writer, PROFILER.span('rerank', dataset=dataset, queries=len(bm25_results)):
+            if rerank_result is not None:
+                for qid, ranked in rerank_result.items():
+                    run_writer.write(qid, ranked)
+            else:
+                # 完了済みのクエリはジャーナルから読み出し、残りだけ rerank する
+                # カスケードは段ごとの所要時間を stats に足し込み、台帳の timings に残す
+                stats = {'stats': cascade_stats} if hasattr(retriever, 'final') else {}
+                rerank_result = journal.resume_rerank(
+                    retriever,
+                    bm25_results,
+                    gen_key,
+                    journal.open_stage(args, 'rerank', dataset),
+                    run_writer=run_writer,
+                    topk=args.dense_topk,
+                    use_enhanced_query=True,
+                    index_name=benchmark.THE_INDEX[dataset],
+                    **stats
+                )
 
-            # 6. 評価
-            logging.info("📊 Evaluating...")
-            qrels_path = Evaluator.get_qrels_path(dataset)
-            
-            if qrels_path and os.path.exists(run_path):
+        # 4. 結果の保存 (結果 + 疑似参照文)
+        # JSON Lines はクエリごとに書き出し、文書本文は docid 参照でファイル内に1回だけ持つ
+        json_path = resultio.result_path(os.path.join(args.output_path, args.llm, run_tag), args.result_format)
+        logging.info(f"💾 Saving results to: {json_path}")
+        if args.result_format == 'json':
+            utils.dump_json(utils.normalize_rerank_to_bm25_json(rerank_result, bm25_results), json_path)
+        else:
+            with resultio.ResultWriter(json_path, index_name=benchmark.THE_INDEX[dataset],
+                                       with_text=not args.no_result_text) as writer:
+                for entry in utils.iter_normalized_rerank(rerank_result, bm25_results):
+                    writer.write(entry)
+
+        # 5. 評価
+        logging.info("📊 Evaluating...")
+        qrels_path = Evaluator.get_qrels_path(dataset)
+        
+        if qrels_path and os.path.exists(run_path):
+            eval_start = time.perf_counter()
+            if args.evaluator == 'trec_eval':
                 score = Evaluator.run_trec_eval(run_path, qrels_path)
                 logging.info(f"✅ {dataset} Result | nDCG@10: {score:.4f}")
-                
-                # ログを保存
-                summary_filename = f"{args.irmode}.json"
-                summary_path = os.path.join("results", summary_filename)
-                summary_data = utils.load_json(summary_path)
-
-                if args.llm not in summary_data: 
-                    summary_data[args.llm] = {}
-                if args.rank_model not in summary_data[args.llm]: 
-                    summary_data[args.llm][args.rank_model] = {}
-                key_mode = f"{args.mode}_n{args.doc_gen}"
-
-                if key_mode not in summary_data[args.llm][args.rank_model]: 
-                    summary_data[args.llm][args.rank_model][key_mode] = {}
-                
-                summary_data[args.llm][args.rank_model][key_mode][dataset] = score
-                
-                # 保存
-                utils.dump_json(summary_data, summary_path)
-                logging.info(f"📊 Updated summary: {summary_path}")
             else:
-                logging.warning(f"Skipping evaluation for {dataset} (Qrels or Run file missing).")
+                metrics = Evaluator.evaluate(run_path, qrels_path, metrics=('ndcg_cut.10', 'map', 'recall.100', 'recip_rank'))
+                score = metrics.get('ndcg_cut_10', 0.0)
+                logging.info(f"✅ {dataset} Result | nDCG@10: {score:.4f} | MAP: {metrics.get('map', 0.0):.4f} "
+                             f"| R@100: {metrics.get('recall_100', 0.0):.4f} | MRR: {metrics.get('recip_rank', 0.0):.4f}")
+            PROFILER.complete('evaluate', eval_start, time.perf_counter() - eval_start, dataset=dataset)
+            
+            # 台帳に追記し、集計ビュー (results/{irmode}.json) を台帳から作り直す
+            timings = dict(timings or {}, **cascade_stats, rerank_eval_sec=time.perf_counter() - start)
+            ledger = ResultsLedger(args.ledger)
+            summary_path = os.path.join("results", f"{args.irmode}.json")
+            ledger.import_legacy_summary(args.irmode, summary_path)
+            ledger.append(
+                args.irmode, args.llm, rank_model_label(args), args.mode, args.doc_gen, dataset,
+                metrics=metrics if args.evaluator != 'trec_eval' else {'ndcg_cut_10': score},
+                timings=timings, config=vars(args)
+            )
+            ledger.export_summary(args.irmode, summary_path)
+            logging.info(f"📊 Updated summary: {summary_path}")
+        else:
+            logging.warning(f"Skipping evaluation for {dataset} (Qrels or Run file missing).")
+
+    logging.info(f"Finished {dataset}.\n")
+
+
+def run_pipeline(args, data_list, generator, retriever, reference=None):
+    """
+    データセット単位のパイプライン。生成 + BM25 (stage 1) と rerank + 評価 (stage 2) を
+    別スレッドで動かし、サイズ上限付きのキューでつなぐ。
+    データセット N を rerank している間にデータセット N+1 の生成・検索を進められる。
+    """
+    todo = queue.Queue()
+    for dataset in data_list:
+        todo.put(dataset)
+    ready = queue.Queue(maxsize=max(1, args.queue_size))
+
+    def search_worker():
+        try:
+            while True:
+                try:
+                    dataset = todo.get_nowait()
+                except queue.Empty:
+                    return
+                start = time.perf_counter()
+                bm25_results = search_dataset(dataset, generator, args, retriever)
+                if bm25_results is not None:
+                    ready.put((dataset, bm25_results, {'search_sec': time.perf_counter() - start}))
+        finally:
+            docstore.detach_jvm()
+
+    def rerank_worker():
+        try:
+            while True:
+                item = ready.get()
+                if item is None:
+                    return
+                dataset, bm25_results, timings = item
+                try:
+                    rerank_dataset(dataset, bm25_results, retriever, args, reference, timings)
+                except Exception as e:
+                    logging.error(f"Error in Reranking for {dataset}: {e}")
+        finally:
+            docstore.detach_jvm()
+
+    searchers = [threading.Thread(target=search_worker, name=f"search-{i}") for i in range(max(1, args.search_workers))]
+    rerankers = [threading.Thread(target=rerank_worker, name=f"rerank-{i}") for i in range(max(1, args.rerank_workers))]
+    for t in searchers + rerankers:
+        t.start()
+    for t in searchers:
+        t.join()
+    for _ in rerankers:
+        ready.put(None)
+    for t in rerankers:
+        t.join()
+
+
+def run_sharded(args, data_list):
+    """
+    --shards N: データセットごとにトピックを N 個に分け、ワーカープロセスで 生成 + BM25 + rerank を並列に行う。
+    保存と評価は結合した結果に対してこのプロセスで行う (出力はシャード数によらず同じ)。
+    """
+    from src.shard import ShardRunner
+
+    if args.check_drift > 0:
+        logging.warning("--check_drift is not supported with --shards; skipping the drift check")
+    if args.irmode == 'mugidense':
+        # コーパスの埋め込みと IVF 索引はワーカーを起動する前にこのプロセスで1回だけ作る
+        from src import ann
+        # ワーカーは埋め込みストアなしでは DenseIndex を作れないので、コーパスをエンコードする前に止める
+        if args.no_emb_cache:
+            raise ValueError(ann.NO_STORE_ERROR)
+        from src.retriever import NeuralRetriever
+        retriever = NeuralRetriever(model_name=args.rank_model, mode=args.mode, emb_cache=args.emb_cache,
+                                    max_batch_tokens=args.max_batch_tokens, inference=args.inference)
+        for index_name in dict.fromkeys(benchmark.THE_INDEX[dataset] for dataset in data_list):
+            ann.get_dense_index(retriever, index_name, args.ann_nlist, args.corpus_chunk).load(
+                docstore.get_searcher(index_name))
+        del retriever
+    with ShardRunner(args) as runner:
+        for dataset in data_list:
+            logging.info(f"#" * 30)
+            logging.info(f"Processing Dataset: {dataset} ({args.shards} shards)")
+            logging.info(f"#" * 30)
+            try:
+                if args.fresh:
+                    journal.discard_dataset(args, dataset)
+                # 検索はワーカーが行うので、親プロセスでは searcher (JVM と索引) を開かない
+                topics, _ = SparseSearcher.get_topics_qrels(dataset, args.test)
+                bm25_results, rerank_result, timings = runner.run_dataset(dataset, topics)
+            except Exception as e:
+                logging.error(f"Error in sharded search for {dataset}: {e}")
+                continue
+            if not bm25_results:
+                logging.warning(f"No results found for {dataset}. Skipping.")
+                continue
+            try:
+                rerank_dataset(dataset, bm25_results, None, args, timings=timings, rerank_result=rerank_result)
+            except Exception as e:
+                logging.error(f"Error in Reranking for {dataset}: {e}")
 
-        logging.info(f"Finished {dataset}.\n")
 
 if __name__ == "__main__":
     args = config.parse_args()
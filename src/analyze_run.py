@@ -9,6 +9,7 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 from src.evaluation import Evaluator
 from src.utils import convert_json_to_run
+from src.resultio import strip_result_ext
 from src import benchmark
 
 def load_qrels(path):
@@ -114,7 +115,7 @@ def summarize(rows, k, include_delta=False):
 
 def main():
     parser = argparse.ArgumentParser(description="Analyze Gen-QER Results (Detailed)")
-    parser.add_argument('--json', type=str, required=True, help='Path to result JSON file')
+    parser.add_argument('--json', type=str, required=True, help='Path to result file (.jsonl[.gz|.zst] or legacy .json)')
     parser.add_argument('--dataset', type=str, required=True, help='Dataset name (dl19, dl20, etc.)')
     parser.add_argument('--output_dir', type=str, default='results/runs', help='Directory to save analysis files')
     parser.add_argument('--k', type=int, default=10, help='Cutoff k for metrics')
@@ -127,7 +128,7 @@ def main():
 
     # 1. JSON -> RUN 変換
     os.makedirs(args.output_dir, exist_ok=True)
-    filename = os.path.basename(args.json).replace('.json', '.run')
+    filename = os.path.basename(strip_result_ext(args.json)) + '.run'
     run_path = os.path.join(args.output_dir, filename)
     
     print(f"🔄 Converting JSON to TREC Run format...")
@@ -0,0 +1,249 @@
+import os
+import json
+import math
+import time
+import logging
+import threading
+import numpy as np
+from tqdm import tqdm
+from typing import Any, Dict, List, Tuple
+from src import docstore
+from src.embstore import EmbeddingStore
+from src.hits import DocTable, QueryHits, build_query_hits
+from src.profiler import PROFILER
+
+IVF_VERSION = 1
+NO_STORE_ERROR = "Dense first-stage retrieval needs the embedding store (do not use --no_emb_cache)"
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """スコア降順の上位 k 件の位置 (同点は位置の小さい順)。"""
+    if k < len(scores):
+        part = np.argpartition(-scores, k - 1)[:k]
+    else:
+        part = np.arange(len(scores))
+    return part[np.lexsort((part, -scores[part]))]
+
+
+def _assign(x: np.ndarray, centroids: np.ndarray, chunk: int = 65536) -> np.ndarray:
+    """各ベクトルを内積が最大のセントロイドに割り当てる (正規化済みなのでコサイン最大と同じ)。"""
+    out = np.empty(len(x), dtype=np.int32)
+    for start in range(0, len(x), chunk):
+        out[start:start + chunk] = np.argmax(np.asarray(x[start:start + chunk]) @ centroids.T, axis=1)
+    return out
+
+
+def train_kmeans(x: np.ndarray, k: int, iters: int = 10, seed: int = 0) -> np.ndarray:
+    """球面 k-means (セントロイドも正規化する)。空のクラスタはランダムな点で置き直す。"""
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iters):
+        assign = _assign(x, centroids)
+        order = np.argsort(assign, kind='stable')
+        counts = np.bincount(assign, minlength=k)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        nonempty = counts > 0
+        sums = np.zeros_like(centroids)
+        sums[nonempty] = np.add.reduceat(x[order], starts[nonempty], axis=0)
+        empty = np.flatnonzero(~nonempty)
+        sums[empty] = x[rng.choice(len(x), len(empty), replace=False)]
+        centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+    return centroids.astype(np.float32)
+
+
+class IVFIndex:
+    """
+    転置ファイル (IVF-Flat) による近似最近傍探索 (内積)。
+    {dir}/centroids.npy : (nlist, dim) のセントロイド
+    {dir}/offsets.npy   : リスト l のベクトルは [offsets[l], offsets[l+1]) 行目
+    {dir}/rows.npy      : リスト順に並べたベクトルの元の行番号 (EmbeddingStore の行)
+    {dir}/vectors.f32   : リスト順に並べ直したベクトル (np.memmap で読む。1リストは連続領域)
+    検索はクエリに近い nprobe 個のリストだけを走査する (nprobe >= nlist なら全件探索と同じ)。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.centroids = np.load(os.path.join(path, 'centroids.npy'))
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        self.rows = np.load(os.path.join(path, 'rows.npy'), mmap_mode='r')
+        self.vectors = np.memmap(os.path.join(path, 'vectors.f32'), dtype=np.float32, mode='r',
+                                 shape=(self.meta['n_rows'], self.meta['dim']))
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @staticmethod
+    def build(path: str, matrix: np.ndarray, nlist: int = 0, train_size: int = 0, iters: int = 10,
+              seed: int = 0, chunk: int = 65536) -> 'IVFIndex':
+        """matrix (n, dim) から索引を作って path に保存する。nlist=0 なら 4 * sqrt(n)。"""
+        n, dim = matrix.shape
+        nlist = max(1, min(n, nlist or int(4 * math.sqrt(n))))
+        # 学習はサンプル (既定でリストあたり 64 点) で行い、割り当ては全件に行う
+        train_size = min(n, train_size or 64 * nlist)
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(n, train_size, replace=False))
+        start = time.perf_counter()
+        centroids = train_kmeans(np.asarray(matrix[sample], dtype=np.float32), nlist, iters, seed)
+        assign = _assign(matrix, centroids, chunk)
+        rows = np.argsort(assign, kind='stable')
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(assign, minlength=nlist)))).astype(np.int64)
+
+        os.makedirs(path, exist_ok=True)
+        vec_path = os.path.join(path, 'vectors.f32')
+        with open(vec_path, 'wb') as f:
+            for s in range(0, n, chunk):
+                f.write(np.ascontiguousarray(matrix[rows[s:s + chunk]], dtype=np.float32).tobytes())
+        np.save(os.path.join(path, 'centroids.npy'), centroids)
+        np.save(os.path.join(path, 'offsets.npy'), offsets)
+        np.save(os.path.join(path, 'rows.npy'), rows.astype(np.int64))
+        # meta.json を最後に書き、完成した索引の印にする
+        with open(os.path.join(path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({'version': IVF_VERSION, 'n_rows': int(n), 'dim': int(dim), 'nlist': int(nlist),
+                       'train_size': int(train_size), 'iters': iters, 'seed': seed}, f)
+        logging.info(f"Built IVF index: {n} vectors, {nlist} lists ({time.perf_counter() - start:.1f}s) -> {path}")
+        return IVFIndex(path)
+
+    def search(self, queries: np.ndarray, k: int = 100, nprobe: int = 32,
+               query_batch: int = 64) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        各クエリ (正規化済み) について (元の行番号, 内積スコア) の上位 k 件を返す。
+        query_batch 件のクエリごとに、どれかのクエリが選んだリストを1回ずつ読み、
+        そのリストを選んだクエリ全員分の内積を1回の行列積で計算する。
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        nprobe = max(1, min(nprobe, self.nlist))
+        out = []
+        for b in range(0, len(queries), query_batch):
+            start = time.perf_counter()
+            batch = queries[b:b + query_batch]
+            probes = np.stack([_top_k(cs, nprobe) for cs in batch @ self.centroids.T])
+            positions = [[] for _ in batch]
+            scores = [[] for _ in batch]
+            # (リスト, クエリ) の組をリスト順に並べ、リストごとにそれを選んだクエリをまとめる
+            flat = probes.ravel()
+            order = np.argsort(flat, kind='stable')
+            lists, group_starts = np.unique(flat[order], return_index=True)
+            members_all = np.repeat(np.arange(len(batch)), nprobe)[order]
+            for l, members in zip(lists.tolist(), np.split(members_all, group_starts[1:])):
+                s, e = self.offsets[l], self.offsets[l + 1]
+                if e == s:
+                    continue
+                block = self.vectors[s:e] @ batch[members].T
+                for j, qi in enumerate(members):
+                    positions[qi].append(np.arange(s, e))
+                    scores[qi].append(block[:, j])
+            scanned = 0
+            for pos, sc in zip(positions, scores):
+                if not sc:
+                    out.append((np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)))
+                    continue
+                pos, sc = np.concatenate(pos), np.concatenate(sc)
+                scanned += len(sc)
+                top = _top_k(sc, k)
+                out.append((np.asarray(self.rows[pos[top]]), sc[top]))
+            elapsed = time.perf_counter() - start
+            PROFILER.complete('ann_batch', start, elapsed, 'ann', queries=len(batch), scanned=scanned)
+            PROFILER.sample('ann_query_sec', elapsed / len(batch))
+        return out
+
+
+class DenseIndex:
+    """
+    インデックス (benchmark.THE_INDEX) の全文書の埋め込み (EmbeddingStore) とその IVF 索引。
+    埋め込みは rerank の文書キャッシュと同じストアに入るので、どちらかで計算済みの文書はエンコードしない。
+    """
+
+    def __init__(self, retriever, index_name: str, nlist: int = 0, chunk: int = 4096):
+        self.retriever = retriever
+        self.index_name = index_name
+        self.nlist = nlist
+        self.chunk = chunk
+        self.store: EmbeddingStore = retriever.doc_store(index_name)
+        if self.store is None:
+            raise ValueError(NO_STORE_ERROR)
+        self.ivf = None
+        self._lock = threading.Lock()
+
+    def ivf_path(self) -> str:
+        return os.path.join(self.store.dir, f"ivf-{self.nlist or 'auto'}")
+
+    def encode_corpus(self, searcher):
+        """Lucene のインデックスの全文書を chunk 件ずつ埋め込んで追記する (途中で止めても続きから再開できる)。"""
+        n_docs = searcher.num_docs
+        if len(self.store) >= n_docs:
+            return
+        logging.info(f"Encoding corpus {self.index_name}: {n_docs} docs ({len(self.store)} already stored)")
+        with tqdm(total=n_docs, desc="Encoding corpus") as pbar:
+            for start in range(0, n_docs, self.chunk):
+                docs = [searcher.doc(i) for i in range(start, min(n_docs, start + self.chunk))]
+                docs = [d for d in docs if d is not None]
+                docids = [d.docid() for d in docs]
+                rows = self.store.lookup(docids)
+                todo = [i for i, row in enumerate(rows) if row is None]
+                if todo:
+                    embeds = self.retriever._embed_timed([docstore.normalize_raw(docs[i].raw()) for i in todo],
+                                                         cached=len(docids) - len(todo))
+                    self.store.add([docids[i] for i in todo], embeds.float().cpu().numpy())
+                pbar.update(min(n_docs, start + self.chunk) - start)
+
+    def load(self, searcher) -> IVFIndex:
+        """コーパスを埋め込み、ストアの件数と一致する IVF 索引がなければ作る。"""
+        with self._lock:
+            if self.ivf is None:
+                self._load(searcher)
+            return self.ivf
+
+    def _load(self, searcher):
+        self.encode_corpus(searcher)
+        path = self.ivf_path()
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            ivf = IVFIndex(path)
+            if ivf.meta['n_rows'] == len(self.store) and ivf.meta.get('version') == IVF_VERSION:
+                self.ivf = ivf
+                return
+            logging.info(f"IVF index is stale ({ivf.meta['n_rows']} != {len(self.store)} vectors); rebuilding")
+        with PROFILER.span('ann_build', 'ann', index=self.index_name, vectors=len(self.store)):
+            self.ivf = IVFIndex.build(path, self.store.matrix(), self.nlist)
+
+
+# プロセス全体で共有する DenseIndex ((rank_model, inference, インデックス名, nlist) -> インスタンス)
+_DENSE_INDEXES: Dict[tuple, DenseIndex] = {}
+_DENSE_LOCK = threading.Lock()
+
+
+def get_dense_index(retriever, index_name: str, nlist: int = 0, chunk: int = 4096) -> DenseIndex:
+    key = (retriever.model_name, retriever.inference, index_name, nlist)
+    with _DENSE_LOCK:
+        if key not in _DENSE_INDEXES:
+            _DENSE_INDEXES[key] = DenseIndex(retriever, index_name, nlist, chunk)
+        return _DENSE_INDEXES[key]
+
+
+def dense_search(args, topics: Dict[Any, Dict], retriever, searcher, index_name: str, gen_key: str = None,
+                 doc_cache=None) -> List[QueryHits]:
+    """
+    コーパス全体からの密ベクトル検索 (BM25 の代わりの第1段)。クエリは rerank と同じ埋め込み
+    (contex-pool ならクエリ + 疑似参照文の平均) を使い、上位 args.topk 件を BM25 と同じ QueryHits で返す。
+    """
+    index = get_dense_index(retriever, index_name, args.ann_nlist, args.corpus_chunk)
+    ivf = index.load(searcher)
+    keys = index.store.keys()
+    items = [QueryHits(qid, topic['title'], np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32), DocTable(),
+                       {gen_key: topic[gen_key]} if gen_key and gen_key in topic else {})
+             for qid, topic in topics.items()]
+    query_vectors = retriever.encode_queries(items, gen_key, use_enhanced_query=gen_key is not None)
+    with PROFILER.span('ann_search', 'ann', queries=len(items), nprobe=args.ann_nprobe):
+        found = ivf.search(query_vectors.float().cpu().numpy(), args.topk, args.ann_nprobe)
+
+    ranked = [([keys[r] for r in rows.tolist()], scores.tolist()) for rows, scores in found]
+    if doc_cache is None:
+        doc_cache = docstore.DocTextCache(searcher, index_name='')
+    docids = list(dict.fromkeys(d for ids, _ in ranked for d in ids))
+    with PROFILER.span('doc_fetch', 'ann', docs=len(docids)):
+        doc_texts = dict(zip(docids, doc_cache.get_many(docids)))
+    table = DocTable()
+    return [build_query_hits(table, item.qid, item.query, ids, scores, doc_texts, item.extra)
+            for item, (ids, scores) in zip(items, ranked)]
@@ -0,0 +1,61 @@
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+from typing import List, Dict
+
+
+def prompt_hash(messages: List[dict]) -> str:
+    """プロンプト (テンプレート + クエリ) の内容からハッシュキーを作る。"""
+    payload = json.dumps(messages, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class GenerationCache:
+    """
+    生成済み疑似文書の永続キャッシュ (SQLite)。
+    キーは (model, prompt_hash, query, sample_idx)。
+    doc_gen を増やして再実行した場合は不足分のサンプルだけ生成すればよい。
+    """
+
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS generations ('
+            ' model TEXT NOT NULL,'
+            ' prompt_hash TEXT NOT NULL,'
+            ' query TEXT NOT NULL,'
+            ' sample_idx INTEGER NOT NULL,'
+            ' output TEXT NOT NULL,'
+            ' PRIMARY KEY (model, prompt_hash, query, sample_idx))'
+        )
+        self._conn.commit()
+
+    def get(self, model: str, messages: List[dict], query: str = '') -> Dict[int, str]:
+        """キャッシュ済みのサンプルを {sample_idx: output} で返す。"""
+        key = prompt_hash(messages)
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT sample_idx, output FROM generations WHERE model=? AND prompt_hash=? AND query=?',
+                (model, key, query)
+            ).fetchall()
+        return {idx: out for idx, out in rows}
+
+    def put(self, model: str, messages: List[dict], query: str, samples: Dict[int, str]):
+        key = prompt_hash(messages)
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO generations VALUES (?, ?, ?, ?, ?)',
+                [(model, key, query, idx, out) for idx, out in samples.items()]
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
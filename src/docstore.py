@@ -0,0 +1,152 @@
+import os
+import json
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, List, Dict
+
+if TYPE_CHECKING:
+    from pyserini.search.lucene import LuceneSearcher
+
+# プロセス全体で共有する LuceneSearcher / 文書キャッシュ (インデックス名 -> インスタンス)
+_SEARCHERS: Dict[str, 'LuceneSearcher'] = {}
+_DOC_CACHES: Dict[str, 'DocTextCache'] = {}
+_POOL_LOCK = threading.Lock()
+
+
+def get_searcher(index_name: str) -> 'LuceneSearcher':
+    """インデックス名ごとに1つだけ LuceneSearcher を開いて使い回す (dl19/dl20 など)。"""
+    with _POOL_LOCK:
+        if index_name not in _SEARCHERS:
+            # JVM の起動は最初に検索するときまで遅らせる
+            from pyserini.search.lucene import LuceneSearcher
+            _SEARCHERS[index_name] = LuceneSearcher.from_prebuilt_index(index_name)
+        return _SEARCHERS[index_name]
+
+
+def get_doc_cache(index_name: str, capacity: int = 200000, disk_path: str = None,
+                  threads: int = 8) -> 'DocTextCache':
+    """インデックス名ごとに共有される文書本文キャッシュを返す (threads は Lucene から一括取得するスレッド数)。"""
+    searcher = get_searcher(index_name)
+    with _POOL_LOCK:
+        if index_name not in _DOC_CACHES:
+            _DOC_CACHES[index_name] = DocTextCache(searcher, index_name, capacity, disk_path, threads)
+        return _DOC_CACHES[index_name]
+
+
+def detach_jvm():
+    """pyserini (pyjnius) を使ったスレッドは終了前に JVM から切り離す。"""
+    try:
+        import jnius
+        jnius.detach()
+    except Exception:
+        pass
+
+
+def normalize_raw(raw) -> str:
+    """Lucene の raw 文書を 'Title: ... Content: ...' 形式の1行テキストにする。"""
+    try:
+        if isinstance(raw, bytes): raw = raw.decode('utf-8')
+        content = json.loads(raw)
+        text_content = content.get('text', content.get('contents', ''))
+        if 'title' in content:
+            text_content = f"Title: {content['title']} Content: {text_content}"
+    except:
+        text_content = "" # Fallback
+    return ' '.join(text_content.split())
+
+
+class DocTextCache:
+    """
+    docid -> 正規化済み本文 の LRU キャッシュ。
+    disk_path を指定すると SQLite にも保存し、次回以降の実行でも再利用する。
+    """
+
+    def __init__(self, searcher: 'LuceneSearcher', index_name: str, capacity: int = 200000,
+                 disk_path: str = None, threads: int = 8):
+        self.searcher = searcher
+        self.index_name = index_name
+        self.capacity = capacity
+        self.threads = threads
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        if disk_path:
+            if os.path.dirname(disk_path):
+                os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+            self._conn = sqlite3.connect(disk_path, check_same_thread=False, timeout=60)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS docs ('
+                ' idx TEXT NOT NULL, docid TEXT NOT NULL, text TEXT NOT NULL,'
+                ' PRIMARY KEY (idx, docid))'
+            )
+            self._conn.commit()
+
+    def get(self, docid: str) -> str:
+        return self.get_many([docid])[0]
+
+    def get_many(self, docids: List[str]) -> List[str]:
+        """複数文書の本文をまとめて取得する (メモリ -> ディスク -> Lucene の順)。"""
+        found = {}
+        with self._lock:
+            for docid in docids:
+                if docid in self._lru:
+                    self._lru.move_to_end(docid)
+                    found[docid] = self._lru[docid]
+        missing = [d for d in dict.fromkeys(docids) if d not in found]
+
+        if missing and self._conn is not None:
+            from_disk = self._load_disk(missing)
+            found.update(from_disk)
+            self._remember(from_disk)
+            missing = [d for d in missing if d not in from_disk]
+
+        if missing:
+            fetched = self._fetch(missing)
+            found.update(fetched)
+            self._remember(fetched)
+            if self._conn is not None:
+                with self._lock:
+                    self._conn.executemany(
+                        'INSERT OR REPLACE INTO docs VALUES (?, ?, ?)',
+                        [(self.index_name, d, t) for d, t in fetched.items()]
+                    )
+                    self._conn.commit()
+
+        return [found.get(d, '') for d in docids]
+
+    def _fetch(self, docids: List[str]) -> Dict[str, str]:
+        """Lucene から本文を取得する。batch_doc があればマルチスレッドで一括取得。"""
+        if hasattr(self.searcher, 'batch_doc') and len(docids) > 1:
+            try:
+                docs = self.searcher.batch_doc(docids, self.threads)
+                return {d: normalize_raw(docs[d].raw()) if docs.get(d) is not None else '' for d in docids}
+            except Exception as e:
+                logging.warning(f"batch_doc failed ({e}); fetching documents one by one")
+        out = {}
+        for d in docids:
+            doc = self.searcher.doc(d)
+            out[d] = normalize_raw(doc.raw()) if doc is not None else ''
+        return out
+
+    def _load_disk(self, docids: List[str]) -> Dict[str, str]:
+        out = {}
+        with self._lock:
+            for start in range(0, len(docids), 500):
+                chunk = docids[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT docid, text FROM docs WHERE idx=? AND docid IN ({','.join('?' * len(chunk))})",
+                    [self.index_name] + chunk
+                ).fetchall()
+                out.update(rows)
+        return out
+
+    def _remember(self, docs: Dict[str, str]):
+        with self._lock:
+            for docid, text in docs.items():
+                self._lru[docid] = text
+                self._lru.move_to_end(docid)
+            while len(self._lru) > self.capacity:
+                self._lru.popitem(last=False)
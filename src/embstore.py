@@ -0,0 +1,178 @@
+import os
+import re
+import json
+import threading
+import numpy as np
+from contextlib import contextmanager
+from typing import List, Optional
+
+try:
+    import fcntl
+    msvcrt = None
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+def _slug(name: str) -> str:
+    return re.sub(r'[^A-Za-z0-9._-]+', '_', name)
+
+
+@contextmanager
+def _process_lock(path: str):
+    """ロックファイルによるプロセス間の排他ロック (POSIX: flock, Windows: msvcrt.locking)。"""
+    with open(path, 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class EmbeddingStore:
+    """
+    埋め込みの永続ストア (追記専用)。
+    {root}/{model}/{namespace}/vectors.f32 : float32 行列 (np.memmap で読む)
+    {root}/{model}/{namespace}/keys.txt    : 各行に対応するキー (docid など)
+    ベクトルを先に書き、キーの追記をコミットとみなすため、途中で落ちても整合性が保たれる
+    (コミットされなかった末尾は次の add が上書きし、開き直したときは切り詰める)。
+    書き込みはロックファイルで直列化するので、複数プロセス (--shards) から同じストアに追記してよい。
+    他のプロセスが追記したキーは lookup / add のときに読み込む。
+    """
+
+    def __init__(self, root: str, model_name: str, namespace: str = 'default'):
+        self.dir = os.path.join(root, _slug(model_name), _slug(namespace))
+        os.makedirs(self.dir, exist_ok=True)
+        self.vec_path = os.path.join(self.dir, 'vectors.f32')
+        self.key_path = os.path.join(self.dir, 'keys.txt')
+        self.meta_path = os.path.join(self.dir, 'meta.json')
+        self.lock_path = os.path.join(self.dir, '.lock')
+        self._lock = threading.Lock()
+        self._index = {}
+        self._matrix = None
+        self._key_offset = 0
+        self.dim = None
+
+        with _process_lock(self.lock_path):
+            if os.path.exists(self.meta_path):
+                with open(self.meta_path, encoding='utf-8') as f:
+                    self.dim = json.load(f)['dim']
+            if self.dim:
+                keys = []
+                if os.path.exists(self.key_path):
+                    with open(self.key_path, encoding='utf-8') as f:
+                        keys = f.read().split('\n')[:-1]
+                # 書き込み途中で落ちた場合は、キーとベクトルの短い方に揃えて切り詰める
+                n_rows = os.path.getsize(self.vec_path) // (4 * self.dim) if os.path.exists(self.vec_path) else 0
+                n_rows = min(n_rows, len(keys))
+                if os.path.exists(self.vec_path):
+                    os.truncate(self.vec_path, n_rows * 4 * self.dim)
+                if len(keys) > n_rows:
+                    with open(self.key_path, 'w', encoding='utf-8') as f:
+                        f.write(''.join(k + '\n' for k in keys[:n_rows]))
+                for row, key in enumerate(keys[:n_rows]):
+                    self._index[key] = row
+            self._key_offset = os.path.getsize(self.key_path) if os.path.exists(self.key_path) else 0
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def _refresh(self):
+        """他のプロセスが追記したキーを読み込む (self._lock を取った状態で呼ぶ)。"""
+        size = os.path.getsize(self.key_path) if os.path.exists(self.key_path) else 0
+        if size <= self._key_offset:
+            return
+        if self.dim is None:
+            with open(self.meta_path, encoding='utf-8') as f:
+                self.dim = json.load(f)['dim']
+        with open(self.key_path, 'rb') as f:
+            f.seek(self._key_offset)
+            data = f.read(size - self._key_offset)
+        # 改行までを書き終えたキーだけを取り込む
+        data = data[:data.rfind(b'\n') + 1]
+        for key in data.decode('utf-8').split('\n')[:-1]:
+            self._index[key] = len(self._index)
+        self._key_offset += len(data)
+
+    def lookup(self, keys: List[str]) -> List[Optional[int]]:
+        """各キーの行番号 (未登録なら None) を返す。"""
+        with self._lock:
+            self._refresh()
+            return [self._index.get(k) for k in keys]
+
+    def keys(self) -> List[str]:
+        """行番号順のキー。"""
+        with self._lock:
+            self._refresh()
+            return list(self._index)
+
+    def matrix(self) -> np.ndarray:
+        """全行の埋め込み (len(self), dim) を np.memmap で返す。"""
+        with self._lock:
+            self._refresh()
+            if self._matrix is None or self._matrix.shape[0] != len(self._index):
+                self._matrix = np.memmap(self.vec_path, dtype=np.float32, mode='r',
+                                         shape=(len(self._index), self.dim))
+            return self._matrix
+
+    def vectors(self, rows: List[int]) -> np.ndarray:
+        """行番号のリストに対応する埋め込みを (len(rows), dim) で返す。"""
+        with self._lock:
+            if self._matrix is None or self._matrix.shape[0] < len(self._index):
+                self._matrix = np.memmap(self.vec_path, dtype=np.float32, mode='r',
+                                         shape=(len(self._index), self.dim))
+            return np.asarray(self._matrix[rows])
+
+    def add(self, keys: List[str], vectors: np.ndarray):
+        """新しいキーと埋め込みを追記する (登録済みのキーは無視)。"""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self._lock, _process_lock(self.lock_path):
+            self._refresh()
+            if self.dim is None:
+                if os.path.exists(self.meta_path):
+                    with open(self.meta_path, encoding='utf-8') as f:
+                        self.dim = json.load(f)['dim']
+                else:
+                    self.dim = int(vectors.shape[1])
+                    with open(self.meta_path, 'w', encoding='utf-8') as f:
+                        json.dump({'dim': self.dim}, f)
+            new_rows, new_keys, seen = [], [], set()
+            for key, vec in zip(keys, vectors):
+                if key in self._index or key in seen or '\n' in key:
+                    continue
+                seen.add(key)
+                new_keys.append(key)
+                new_rows.append(vec)
+            if not new_keys:
+                return
+            # 他のプロセスがベクトルだけ (またはキーの途中まで) 書いて落ちていると、末尾に余分なバイトが残る。
+            # 追記位置を確定済みの行数 / キーの末尾に合わせてから書くことで、行番号とベクトルの対応を保つ
+            with open(self.vec_path, 'r+b' if os.path.exists(self.vec_path) else 'w+b') as f:
+                f.seek(len(self._index) * 4 * self.dim)
+                f.truncate()
+                f.write(np.stack(new_rows).tobytes())
+            data = ''.join(k + '\n' for k in new_keys).encode('utf-8')
+            with open(self.key_path, 'r+b' if os.path.exists(self.key_path) else 'w+b') as f:
+                f.seek(self._key_offset)
+                f.truncate()
+                f.write(data)
+            self._key_offset += len(data)
+            base = len(self._index)
+            for offset, key in enumerate(new_keys):
+                self._index[key] = base + offset
@@ -3,16 +3,17 @@ import re
 import subprocess
 import platform
 import logging
-from pyserini.search import get_qrels_file
-from pyserini.util import download_evaluation_script
-from src import benchmark
+import numpy as np
+from collections import defaultdict
+from typing import Dict, List, Tuple, Union
+from src import benchmark, snapshot
 
 class Evaluator:
     @staticmethod
     def get_qrels_path(dataset_name):
         """
         データセット名から自動でqrelsファイルのパスを取得する。
-        ダウンロードされていない場合はPyseriniが自動ダウンロードする。
+        パスはローカルのスナップショットに記録しておき、ない場合だけPyseriniが取得（自動ダウンロード）する。
         """
         topic_key = benchmark.THE_TOPICS.get(dataset_name)
         if not topic_key:
@@ -20,8 +21,7 @@ class Evaluator:
             return None
         
         try:
-            # Pyseriniがキャッシュからパスを返す（なければダウンロード）
-            return get_qrels_file(topic_key)
+            return snapshot.get_qrels_file(topic_key)
         except Exception as e:
             logging.error(f"Failed to get qrels for {dataset_name}: {e}")
             return None
@@ -35,6 +35,7 @@ class Evaluator:
             logging.error("Run file or Qrels file missing.")
             return 0.0
 
+        from pyserini.util import download_evaluation_script
         script_path = download_evaluation_script('trec_eval')
         cmd = ['java', '-Dfile.encoding=UTF-8', '-jar', script_path, '-c', '-m', metric, qrels_path, run_path]
         
@@ -51,4 +52,109 @@ class Evaluator:
         match = re.search(r'\d+\.\d+', output.split('\t')[-1]) if '\t' in output else re.search(r'\d+\.\d+', output)
         
         score = float(match.group(0)) if match else 0.0
-        return score
\ No newline at end of file
+        return score
+
+    # ---- trec_eval を使わない評価 (trec_eval -c と同じ定義) ----
+    _QRELS_CACHE = {}
+
+    @staticmethod
+    def load_qrels(qrels_path) -> Dict[str, Dict[str, int]]:
+        """qrels を {qid: {docid: rel}} として読み込む (パスごとに1回だけ)。"""
+        if qrels_path not in Evaluator._QRELS_CACHE:
+            qrels = defaultdict(dict)
+            with open(qrels_path, encoding='utf-8') as f:
+                for line in f:
+                    p = line.split()
+                    if len(p) < 4: continue
+                    qrels[p[0]][p[2]] = int(p[3])
+            Evaluator._QRELS_CACHE[qrels_path] = dict(qrels)
+        return Evaluator._QRELS_CACHE[qrels_path]
+
+    @staticmethod
+    def load_run(run_path) -> Dict[str, List[Tuple[str, float]]]:
+        run = defaultdict(list)
+        with open(run_path, encoding='utf-8') as f:
+            for line in f:
+                p = line.split()
+                if len(p) < 6: continue
+                run[p[0]].append((p[2], float(p[4])))
+        return dict(run)
+
+    @staticmethod
+    def evaluate(run: Union[str, Dict[str, List[Tuple[str, float]]]], qrels_path,
+                 metrics=('ndcg_cut.10',), per_query=False) -> Dict[str, float]:
+        """
+        RUN (ファイルパス or {qid: [(docid, score)]}) を一括で評価する。
+        trec_eval -c と同じく qrels の全クエリで平均し (RUN にないクエリは 0)、
+        スコア降順・同点は docid 降順で並べる。rel >= 1 を適合とみなす。
+        対応指標: ndcg_cut.k / map / recall.k / P.k / recip_rank (キーは trec_eval の出力名)
+        """
+        if isinstance(run, str):
+            if not os.path.exists(run) or not os.path.exists(qrels_path):
+                logging.error("Run file or Qrels file missing.")
+                return {}
+            run = Evaluator.load_run(run)
+        qrels = Evaluator.load_qrels(qrels_path)
+        qids = list(qrels)
+
+        parsed = []
+        for m in metrics:
+            name, _, cut = m.partition('.')
+            parsed.append((name, int(cut) if cut else None))
+        max_k = max([k for _, k in parsed if k] + [1])
+
+        # ランキングを (クエリ数 x 深さ) のゲイン行列にする
+        rankings = []
+        for qid in qids:
+            seen, docs = set(), []
+            for docid, score in sorted(run.get(qid, []), key=lambda x: (x[1], x[0]), reverse=True):
+                if docid not in seen:
+                    seen.add(docid)
+                    docs.append(docid)
+            rankings.append(docs)
+        depth = max([len(r) for r in rankings] + [max_k])
+        gains = np.zeros((len(qids), depth))
+        for i, (qid, docs) in enumerate(zip(qids, rankings)):
+            judged = qrels[qid]
+            gains[i, :len(docs)] = [judged.get(d, 0) for d in docs]
+        gains = np.maximum(gains, 0)
+        rel = gains >= 1
+        num_rel = np.array([sum(1 for v in qrels[qid].values() if v >= 1) for qid in qids], dtype=float)
+
+        ranks = np.arange(1, depth + 1)
+        discounts = 1.0 / np.log2(ranks + 1)
+        cum_rel = np.cumsum(rel, axis=1)
+
+        per_q = {}
+        for (name, k), metric in zip(parsed, metrics):
+            if name == 'ndcg_cut':
+                dcg = (gains[:, :k] * discounts[:k]).sum(axis=1)
+                ideal = np.zeros((len(qids), k))
+                for i, qid in enumerate(qids):
+                    top = sorted((v for v in qrels[qid].values() if v > 0), reverse=True)[:k]
+                    ideal[i, :len(top)] = top
+                idcg = (ideal * discounts[:k]).sum(axis=1)
+                values = np.divide(dcg, idcg, out=np.zeros_like(dcg), where=idcg > 0)
+                key = f'ndcg_cut_{k}'
+            elif name == 'map':
+                prec = (rel * cum_rel / ranks).sum(axis=1)
+                values = np.divide(prec, num_rel, out=np.zeros_like(prec), where=num_rel > 0)
+                key = 'map'
+            elif name == 'recall':
+                hits = cum_rel[:, k - 1].astype(float)
+                values = np.divide(hits, num_rel, out=np.zeros_like(hits), where=num_rel > 0)
+                key = f'recall_{k}'
+            elif name == 'P':
+                values = cum_rel[:, k - 1] / k
+                key = f'P_{k}'
+            elif name == 'recip_rank':
+                first = rel.argmax(axis=1)
+                values = np.where(rel.any(axis=1), 1.0 / (first + 1), 0.0)
+                key = 'recip_rank'
+            else:
+                raise NotImplementedError(f"Metric {metric} is not implemented.")
+            per_q[key] = values
+
+        if per_query:
+            return {key: dict(zip(qids, values.tolist())) for key, values in per_q.items()}
+        return {key: float(values.mean()) if len(values) else 0.0 for key, values in per_q.items()}
@@ -1,22 +1,55 @@
 import os
+import copy
+import time
+import logging
+import threading
 import torch
-from typing import List
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Tuple
+from tqdm import tqdm
+from transformers import AutoTokenizer, AutoModelForCausalLM, DynamicCache
+from openai import OpenAI, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+from src.cache import GenerationCache
+from src.ratelimit import RateLimiter
+from src.profiler import PROFILER
 
 class LLMGenerator:
-    def __init__(self, model_name: str):
+    # これより短い共通接頭辞は KV キャッシュしない
+    MIN_PREFIX_TOKENS = 16
+    # ローカル生成でキャッシュに保存する単位 (プロンプト数)
+    LOCAL_CHECKPOINT = 64
+
+    def __init__(self, model_name: str, cache_path: str = None, workers: int = 8,
+                 tokens_per_minute: int = None, base_url: str = None, max_retries: int = 8,
+                 batch_size: int = 16, prefix_cache: bool = True):
         self.model_name = model_name
         self.client = None
         self.hf_model = None
         self.tokenizer = None
-        
+        # 生成結果の永続キャッシュ (None なら無効)
+        self.cache = GenerationCache(cache_path) if cache_path else None
+        self.workers = max(1, workers)
+        self.max_retries = max_retries
+        # ローカルモデルの1回の generate あたりの最大行数
+        self.batch_size = max(1, batch_size)
+        self.last_throughput = 0.0
+        # テンプレート共通部分の KV キャッシュ {prefix token ids: DynamicCache}
+        self.use_prefix_cache = prefix_cache
+        self._prefix_caches = {}
+        # ローカルモデルは複数スレッドから同時に generate させない
+        self._local_lock = threading.Lock()
+        self.limiter = RateLimiter(tokens_per_minute)
+        # 1サンプルあたりの出力トークン数の推定値 (応答の usage で更新)
+        self._completion_tokens = 256.0
+        self._short_n_warned = False
+
         if 'gpt' in model_name:
-            # OpenAI Client
+            # OpenAI Client (base_url を指定すればローカルのスタブサーバでも動く)
             api_key = os.environ.get('OPENAI_KEY')
             if not api_key:
                 raise ValueError("OPENAI_KEY environment variable is not set.")
-            self.client = OpenAI(api_key=api_key)
+            # リトライは RateLimiter 側で行う
+            self.client = OpenAI(api_key=api_key, base_url=base_url or os.environ.get('OPENAI_BASE_URL'), max_retries=0)
         else:
             # HuggingFace Model
             print(f"Loading local LLM: {model_name}...")
@@ -25,55 +58,286 @@ class LLMGenerator:
                 device_map="auto",
                 torch_dtype='auto'
             ).eval()
-            self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+            # バッチ生成のため左パディング
+            self.tokenizer = AutoTokenizer.from_pretrained(model_name, padding_side='left')
+
+    def generate_samples(self, messages: List[dict], n: int, query: str = '') -> List[str]:
+        """
+        n 個の疑似文書を返す。キャッシュ済みのサンプルは再利用し、不足分だけ生成する。
+        """
+        return self.generate_many([(messages, query)], n)[0]
+
+    def generate_many(self, requests: List[Tuple[List[dict], str]], n: int, desc: str = "Generating") -> List[List[str]]:
+        """
+        (messages, query) のリストそれぞれについて n 個の疑似文書を返す。
+        キャッシュにない分だけを並列に生成し、結果の順序は入力順・サンプル番号順で固定。
+        """
+        results = []
+        pending = []  # (request_idx, missing sample indices)
+        for idx, (messages, query) in enumerate(requests):
+            cached = self.cache.get(self.model_name, messages, query) if self.cache else {}
+            results.append(cached)
+            missing = [i for i in range(n) if i not in cached]
+            if missing:
+                pending.append((idx, missing))
+
+        if pending:
+            logging.info(f"Generating {sum(len(m) for _, m in pending)} samples for {len(pending)} prompts "
+                         f"({len(requests) - len(pending)} fully cached)")
+            self._run_pending(requests, pending, results, desc)
+
+        return [[results[idx][i] for i in range(n)] for idx in range(len(requests))]
+
+    def _run_pending(self, requests, pending, results, desc):
+        def task(idx, missing):
+            messages, _ = requests[idx]
+            outputs = self._generate_n(messages, len(missing))
+            return idx, dict(zip(missing, [o.strip() for o in outputs]))
+
+        def store(idx, samples):
+            messages, query = requests[idx]
+            if self.cache:
+                self.cache.put(self.model_name, messages, query, samples)
+            results[idx].update(samples)
+
+        if self.client is None:
+            # ローカルモデル: LOCAL_CHECKPOINT 件のプロンプトごとにまとめてバッチ生成し、その都度キャッシュに保存する
+            # (途中で落ちても生成済みのクエリはやり直さない)
+            for start in range(0, len(pending), self.LOCAL_CHECKPOINT):
+                chunk = pending[start:start + self.LOCAL_CHECKPOINT]
+                prompt_ids = [self._prompt_ids(requests[idx][0]) for idx, _ in chunk]
+                outputs = self._generate_local(prompt_ids, [len(missing) for _, missing in chunk])
+                for (idx, missing), samples in zip(chunk, outputs):
+                    store(idx, dict(zip(missing, [o.strip() for o in samples])))
+            logging.info(f"Local generation throughput: {self.last_throughput:.1f} tokens/sec")
+            return
+
+        if self.workers == 1:
+            for idx, missing in tqdm(pending, desc=desc):
+                store(*task(idx, missing))
+            return
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(task, idx, missing) for idx, missing in pending]
+            for future in tqdm(as_completed(futures), total=len(futures), desc=desc):
+                store(*future.result())
+
+    def _generate_n(self, messages: List[dict], n: int) -> List[str]:
+        """1つのプロンプトから n 個生成する。OpenAI は n 引数で1リクエストにまとめる。"""
+        if 'gpt' in self.model_name:
+            return self._chat_openai(messages, n)
+        return self._generate_local([self._prompt_ids(messages)], [n])[0]
 
     def generate(self, messages: List[dict]) -> str:
         """Unified generation method for both OpenAI and Local LLMs."""
         if 'gpt' in self.model_name:
-            response = self.client.chat.completions.create(
-                model=self.model_name if 'gpt' in self.model_name else 'gpt-3.5-turbo',
-                messages=messages
+            return self._chat_openai(messages, 1)[0]
+        # Local HF (Qwen / 01-ai / default)
+        return self._generate_local([self._prompt_ids(messages)], [1])[0][0]
+
+    def _estimate_tokens(self, messages: List[dict], n: int) -> int:
+        prompt_chars = sum(len(m.get('content', '')) for m in messages)
+        return int(prompt_chars / 4 + n * self._completion_tokens)
+
+    def _chat_openai(self, messages: List[dict], n: int = 1) -> List[str]:
+        """
+        n 個の応答を返す。n を無視して choices を少なく返すサーバ (OpenAI 互換 API に多い) には
+        不足分だけリクエストし直す。
+        """
+        outputs = []
+        while len(outputs) < n:
+            want = n - len(outputs)
+            choices = self._chat_openai_once(messages, want)
+            if not choices:
+                raise RuntimeError(f"{self.model_name} returned 0 choices (requested n={want})")
+            if len(choices) < want and not self._short_n_warned:
+                self._short_n_warned = True
+                logging.warning(f"{self.model_name} returned {len(choices)} choices for n={want}; "
+                                f"requesting the remaining samples separately")
+            outputs.extend(choices[:want])
+        return outputs
+
+    def _chat_openai_once(self, messages: List[dict], n: int) -> List[str]:
+        for attempt in range(self.max_retries + 1):
+            entry = self.limiter.acquire(self._estimate_tokens(messages, n))
+            request_start = time.perf_counter()
+            try:
+                response = self.client.chat.completions.create(
+                    model=self.model_name,
+                    messages=messages,
+                    n=n
+                )
+            except RateLimitError as e:
+                self.limiter.settle(entry, 0)
+                if attempt == self.max_retries:
+                    raise
+                retry_after = e.response.headers.get('retry-after') if e.response is not None else None
+                try:
+                    retry_after = float(retry_after) if retry_after else None
+                except ValueError:
+                    retry_after = None
+                delay = self.limiter.on_rate_limit(retry_after)
+                logging.warning(f"Rate limited (429), backing off {delay:.1f}s (attempt {attempt + 1})")
+                continue
+            except (APIConnectionError, APITimeoutError, InternalServerError) as e:
+                self.limiter.settle(entry, 0)
+                if attempt == self.max_retries:
+                    raise
+                delay = self.limiter.on_rate_limit()
+                logging.warning(f"OpenAI request failed ({e.__class__.__name__}), retrying in {delay:.1f}s")
+                continue
+
+            self.limiter.on_success()
+            PROFILER.complete('llm_request', request_start, time.perf_counter() - request_start, 'llm', n=n)
+            if response.usage is not None:
+                PROFILER.sample('llm_prompt_tokens', response.usage.prompt_tokens)
+                PROFILER.sample('llm_completion_tokens', response.usage.completion_tokens)
+                self.limiter.settle(entry, response.usage.total_tokens)
+                per_sample = response.usage.completion_tokens / max(1, len(response.choices))
+                self._completion_tokens = 0.9 * self._completion_tokens + 0.1 * per_sample
+            choices = sorted(response.choices, key=lambda c: c.index)
+            return [c.message.content or '' for c in choices]
+
+    def _prompt_ids(self, messages: List[dict]) -> List[int]:
+        """ローカルモデル用にチャットテンプレートを適用してトークン列を返す。"""
+        if 'Qwen' in self.model_name:
+            text = self.tokenizer.apply_chat_template(
+                messages[:-1],
+                tokenize=False,
+                add_generation_prompt=True
             )
-            return response.choices[0].message.content
-        
-        elif 'Qwen' in self.model_name:
-            return self._chat_qwen(messages)
+            return self.tokenizer(text)['input_ids']
         elif '01-ai' in self.model_name:
-            return self._chat_yi(messages)
-        else:
-            # Default HF
-            return self._chat_default(messages)
-
-    def _chat_qwen(self, messages: List[dict]) -> str:
-        text = self.tokenizer.apply_chat_template(
-            messages[:-1], 
-            tokenize=False,
-            add_generation_prompt=True
-        )
-        model_inputs = self.tokenizer([text], return_tensors="pt").to(self.hf_model.device)
+            return list(self.tokenizer.apply_chat_template(
+                conversation=messages[:-1],
+                tokenize=True,
+                add_generation_prompt=True
+            ))
+        # Generic HF implementation
+        return list(self.tokenizer.apply_chat_template(messages, tokenize=True))
+
+    def _generation_kwargs(self, n: int) -> dict:
+        kwargs = {}
+        if 'Qwen' in self.model_name:
+            kwargs['max_new_tokens'] = 1024
+        elif '01-ai' not in self.model_name:
+            kwargs['max_new_tokens'] = 512
+        if n > 1:
+            # 同じプロンプトから複数サンプルを得るためサンプリングを有効化
+            kwargs['do_sample'] = True
+        return kwargs
+
+    def _shared_prefix(self, prompt_ids: List[List[int]]):
+        """
+        全プロンプトに共通するテンプレート部分 (システムメッセージ等) のトークン列を返す。
+        既に KV キャッシュを持つプレフィックスがあればそれを優先し、
+        なければ共通接頭辞を求めて新たに KV キャッシュを作る。最低1トークンは残す。
+        """
+        limit = min(len(ids) for ids in prompt_ids) - 1
+        for prefix in sorted(self._prefix_caches, key=len, reverse=True):
+            if len(prefix) <= limit and all(tuple(ids[:len(prefix)]) == prefix for ids in prompt_ids):
+                return prefix
+        if len(prompt_ids) < 2:
+            return None
+
+        length = 0
+        first = prompt_ids[0]
+        while length < limit and all(ids[length] == first[length] for ids in prompt_ids):
+            length += 1
+        if length < self.MIN_PREFIX_TOKENS:
+            return None
+
+        prefix = tuple(first[:length])
+        cache = DynamicCache()
         with torch.no_grad():
-            generated_ids = self.hf_model.generate(
-                model_inputs.input_ids,
-                max_new_tokens=1024
+            self.hf_model(
+                input_ids=torch.tensor([prefix], dtype=torch.long, device=self.hf_model.device),
+                past_key_values=cache,
+                use_cache=True
             )
-        generated_ids = [
-            output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
-        ]
-        return self.tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
-
-    def _chat_yi(self, messages: List[dict]) -> str:
-        input_ids = self.tokenizer.apply_chat_template(
-            conversation=messages[:-1], 
-            tokenize=True, 
-            add_generation_prompt=True, 
-            return_tensors='pt'
-        )
-        with torch.no_grad():
-            output_ids = self.hf_model.generate(input_ids.to('cuda'))
-        return self.tokenizer.decode(output_ids[0][input_ids.shape[1]:], skip_special_tokens=True)
-
-    def _chat_default(self, messages: List[dict]) -> str:
-        # Generic HF implementation if needed
-        input_ids = self.tokenizer.apply_chat_template(messages, tokenize=True, return_tensors="pt").to("cuda")
-        output = self.hf_model.generate(input_ids, max_new_tokens=512)
-        return self.tokenizer.decode(output[0], skip_special_tokens=True)
\ No newline at end of file
+        self._prefix_caches[prefix] = cache
+        logging.info(f"Cached KV for {length}-token prompt prefix")
+        return prefix
+
+    def _generate_local(self, prompt_ids: List[List[int]], counts: List[int]) -> List[List[str]]:
+        with self._local_lock:
+            return self._generate_local_unlocked(prompt_ids, counts)
+
+    def _generate_local_unlocked(self, prompt_ids: List[List[int]], counts: List[int]) -> List[List[str]]:
+        """
+        複数プロンプトを長さ順に並べ、パディングしたバッチでまとめて生成する。
+        バッチの行数 (プロンプト数 x サンプル数) は batch_size 以下に抑える。
+
+        共通テンプレートの KV キャッシュがある場合は [prefix | pad | クエリ部分] の形に並べ、
+        キャッシュを全行にコピーしてクエリ部分だけを prefill する。
+        (位置は attention_mask の累積和で決まるため、途中のパディングは位置をずらさない)
+        キャッシュがない場合は左パディングし、同じプロンプトのサンプルは
+        num_return_sequences で1回の generate にまとめる。
+        """
+        pad_id = self.tokenizer.pad_token_id
+        if pad_id is None:
+            pad_id = self.tokenizer.eos_token_id
+        device = self.hf_model.device
+        prefix = self._shared_prefix(prompt_ids) if self.use_prefix_cache else None
+        plen = len(prefix) if prefix else 0
+
+        # サンプル数ごとにグループ化し、その中で長さ順に並べる
+        groups = {}
+        for i in range(len(prompt_ids)):
+            groups.setdefault(counts[i], []).append(i)
+        batches = []
+        for n, idxs in groups.items():
+            idxs.sort(key=lambda i: len(prompt_ids[i]))
+            per_batch = max(1, self.batch_size // n)
+            for start in range(0, len(idxs), per_batch):
+                batches.append((n, idxs[start:start + per_batch]))
+
+        outputs = [[] for _ in prompt_ids]
+        new_tokens, start_time = 0, time.perf_counter()
+        for n, batch in tqdm(batches, desc="Local generation", disable=len(batches) <= 1):
+            suffixes = [prompt_ids[i][plen:] for i in batch]
+            max_len = max(len(suf) for suf in suffixes)
+            input_ids = torch.full((len(batch), plen + max_len), pad_id, dtype=torch.long)
+            attention_mask = torch.zeros_like(input_ids)
+            for row, suf in enumerate(suffixes):
+                if plen:
+                    input_ids[row, :plen] = torch.tensor(prefix, dtype=torch.long)
+                    attention_mask[row, :plen] = 1
+                input_ids[row, plen + max_len - len(suf):] = torch.tensor(suf, dtype=torch.long)
+                attention_mask[row, plen + max_len - len(suf):] = 1
+
+            gen_kwargs = self._generation_kwargs(n)
+            if plen:
+                # Cache オブジェクトは num_return_sequences で展開されないため行を複製する
+                input_ids = input_ids.repeat_interleave(n, dim=0)
+                attention_mask = attention_mask.repeat_interleave(n, dim=0)
+                cache = copy.deepcopy(self._prefix_caches[prefix])
+                cache.batch_repeat_interleave(input_ids.shape[0])
+                gen_kwargs['past_key_values'] = cache
+            else:
+                gen_kwargs['num_return_sequences'] = n
+
+            batch_start = time.perf_counter()
+            with torch.no_grad():
+                output_ids = self.hf_model.generate(
+                    input_ids=input_ids.to(device),
+                    attention_mask=attention_mask.to(device),
+                    pad_token_id=pad_id,
+                    **gen_kwargs
+                )
+            generated = output_ids[:, plen + max_len:]
+            batch_tokens = int((generated != pad_id).sum())
+            new_tokens += batch_tokens
+            if PROFILER.enabled:
+                prompt_tokens = int(attention_mask.sum())
+                PROFILER.complete('llm_request', batch_start, time.perf_counter() - batch_start, 'llm',
+                                  rows=int(input_ids.shape[0]), prompt_tokens=prompt_tokens)
+                PROFILER.sample('llm_prompt_tokens', prompt_tokens)
+                PROFILER.sample('llm_completion_tokens', batch_tokens)
+            texts = self.tokenizer.batch_decode(generated, skip_special_tokens=True)
+            for row, i in enumerate(batch):
+                outputs[i] = texts[row * n:(row + 1) * n]
+
+        elapsed = time.perf_counter() - start_time
+        self.last_throughput = new_tokens / elapsed if elapsed > 0 else 0.0
+        return outputs
@@ -0,0 +1,125 @@
+import numpy as np
+from typing import Any, Dict, Iterable, List, Optional
+
+
+class DocTable:
+    """
+    検索結果に現れた文書の intern テーブル (docid -> 行番号 -> 本文)。
+    同じ文書が複数のクエリでヒットしても本文は1つだけ持つ。
+    """
+
+    def __init__(self):
+        self.docids: List[str] = []
+        self.texts: List[str] = []
+        self._rows: Dict[str, int] = {}
+
+    def __len__(self):
+        return len(self.docids)
+
+    def row(self, docid: str) -> Optional[int]:
+        return self._rows.get(docid)
+
+    def intern(self, docid: str, text: str) -> int:
+        row = self._rows.get(docid)
+        if row is None:
+            row = self._rows[docid] = len(self.docids)
+            self.docids.append(docid)
+            self.texts.append(text)
+        return row
+
+
+class QueryHits:
+    """
+    1クエリ分の検索結果を列指向で持つ (文書の行番号と BM25 スコアの配列。順位は配列の位置 + 1)。
+    ホットパス (rerank, 正規化) は docids() / contents() / scores を使う。
+    従来の dict 形式 ({'query', 'qid', 'hits': [...], <疑似参照文>}) と同じキーでも読めるが、
+    'hits' はアクセスのたびに dict のリストを作るので大量に読む処理では使わないこと。
+    """
+    __slots__ = ('qid', 'query', 'rows', 'scores', 'table', 'extra')
+
+    def __init__(self, qid, query: str, rows: np.ndarray, scores: np.ndarray, table: DocTable,
+                 extra: Dict[str, Any] = None):
+        self.qid = qid
+        self.query = query
+        self.rows = rows
+        self.scores = scores
+        self.table = table
+        self.extra = extra or {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def ranks(self) -> np.ndarray:
+        return np.arange(1, len(self.rows) + 1)
+
+    def docids(self, k: int = None) -> List[str]:
+        docids = self.table.docids
+        return [docids[r] for r in self.rows[:k].tolist()]
+
+    def contents(self, k: int = None) -> List[str]:
+        texts = self.table.texts
+        return [texts[r] for r in self.rows[:k].tolist()]
+
+    def score_by_docid(self) -> Dict[str, float]:
+        return dict(zip(self.docids(), self.scores.tolist()))
+
+    def hits(self, k: int = None) -> List[Dict[str, Any]]:
+        """従来形式の hit dict のリストを作る。"""
+        docids, texts = self.table.docids, self.table.texts
+        return [{'content': texts[r], 'qid': self.qid, 'docid': docids[r], 'rank': rank, 'score': score}
+                for rank, (r, score) in enumerate(zip(self.rows[:k].tolist(), self.scores[:k].tolist()), start=1)]
+
+    def with_extra(self, **extra) -> 'QueryHits':
+        """疑似参照文などを差し替えたコピー (配列と DocTable は共有)。"""
+        return QueryHits(self.qid, self.query, self.rows, self.scores, self.table, dict(self.extra, **extra))
+
+    def to_dict(self) -> Dict[str, Any]:
+        entry = {'query': self.query, 'qid': self.qid, 'hits': self.hits()}
+        entry.update(self.extra)
+        return entry
+
+    # ---- 従来の dict 形式との互換 ----
+    def get(self, key: str, default=None):
+        if key == 'query':
+            return self.query
+        if key == 'qid':
+            return self.qid
+        if key == 'hits':
+            return self.hits()
+        return self.extra.get(key, default)
+
+    def __getitem__(self, key: str):
+        if key not in self:
+            raise KeyError(key)
+        return self.get(key)
+
+    def __contains__(self, key: str):
+        return key in ('query', 'qid', 'hits') or key in self.extra
+
+
+def build_query_hits(table: DocTable, qid, query: str, docids: Iterable[str], scores: Iterable[float],
+                     texts: Dict[str, str], extra: Dict[str, Any] = None, score_dtype=np.float32) -> QueryHits:
+    """
+    docid / スコアの列から QueryHits を作る (本文は texts[docid] を table に intern する)。
+    Lucene のスコアは float32 なので既定の float32 で丸めは起きない。
+    """
+    rows = np.fromiter((table.intern(d, texts.get(d, '')) for d in docids), dtype=np.int32)
+    return QueryHits(qid, query, rows, np.fromiter(scores, dtype=score_dtype, count=len(rows)), table, extra)
+
+
+def to_query_hits(rank_result: Iterable[Any]) -> List[QueryHits]:
+    """QueryHits はそのまま、従来の dict 形式のエントリは QueryHits に変換して返す。"""
+    out, table = [], None
+    for item in rank_result:
+        if isinstance(item, QueryHits):
+            out.append(item)
+            continue
+        table = table or DocTable()
+        hits = item.get('hits') or []
+        qid = hits[0]['qid'] if hits else item.get('qid')
+        extra = {k: v for k, v in item.items() if k not in ('query', 'qid', 'hits')}
+        texts = {h['docid']: h.get('content', '') for h in hits}
+        out.append(build_query_hits(table, qid, item.get('query', ''), [h['docid'] for h in hits],
+                                    [h.get('score', 0.0) for h in hits], texts, extra, score_dtype=np.float64))
+    return out
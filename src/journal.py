@@ -0,0 +1,200 @@
+import os
+import json
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, List
+
+# ステージごとに結果を左右する設定 (これが変わると別の run_key になる)
+BM25_PARAMS = ('test', 'topk', 'expansion', 'max_terms', 'repeat_times', 'adaptive_times')
+RERANK_PARAMS = ('rank_model', 'mode', 'inference', 'dense_topk')
+STAGES = ('bm25', 'rerank')
+
+# プロセス全体で共有する StageJournal (パス -> インスタンス)
+_JOURNALS: Dict[str, 'StageJournal'] = {}
+_JOURNALS_LOCK = threading.Lock()
+
+
+class StageJournal:
+    """
+    ステージ (bm25 / rerank) の完了済みクエリの出力を1クエリずつ追記する SQLite のジャーナル。
+    キーは (stage, run_key, qid)。run_key はデータセットとそのステージの結果に影響する設定のハッシュ。
+    途中で落ちても、再実行時は完了済みの qid を読み出して残りだけ処理すればよい。
+    生成ステージは GenerationCache がクエリごとに保存しているので、それをジャーナルとして使う。
+    """
+
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            ' stage TEXT NOT NULL,'
+            ' run_key TEXT NOT NULL,'
+            ' qid TEXT NOT NULL,'
+            ' payload TEXT NOT NULL,'
+            ' PRIMARY KEY (stage, run_key, qid))'
+        )
+        self._conn.commit()
+
+    def load(self, stage: str, run_key: str) -> Dict[str, Any]:
+        """完了済みの {qid (文字列): 出力} を返す。"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT qid, payload FROM entries WHERE stage=? AND run_key=?', (stage, run_key)
+            ).fetchall()
+        return {qid: json.loads(payload) for qid, payload in rows}
+
+    def put_many(self, stage: str, run_key: str, outputs: Dict[Any, Any]):
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                [(stage, run_key, str(qid), json.dumps(out, ensure_ascii=False)) for qid, out in outputs.items()]
+            )
+            self._conn.commit()
+
+    def discard(self, stage: str, run_key: str) -> int:
+        with self._lock:
+            n = self._conn.execute('DELETE FROM entries WHERE stage=? AND run_key=?', (stage, run_key)).rowcount
+            self._conn.commit()
+        return n
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class StageLog:
+    """
+    1つの (stage, run_key) に束縛したジャーナル。
+    run_key は設定しか区別しないので、各クエリの記録にはそのクエリの入力 (クエリ文字列や疑似参照文、候補文書) の
+    ハッシュも持たせ、入力が変わった (生成し直した・プロンプトを変えた) クエリは記録があってもやり直す。
+    """
+
+    def __init__(self, journal: StageJournal, stage: str, run_key: str):
+        self.journal = journal
+        self.stage = stage
+        self.run_key = run_key
+
+    def load(self, digests: Dict[str, str]) -> Dict[str, Any]:
+        """digests ({qid (文字列): 入力のハッシュ}) と入力が一致する記録だけを {qid: 出力} で返す。"""
+        done, stale = {}, 0
+        for qid, payload in self.journal.load(self.stage, self.run_key).items():
+            if qid not in digests:
+                continue
+            if isinstance(payload, dict) and payload.get('input') == digests[qid]:
+                done[qid] = payload['output']
+            else:
+                stale += 1
+        if stale:
+            logging.info(f"Ignoring {stale} journaled {self.stage} queries whose inputs changed")
+        return done
+
+    def put_many(self, outputs: Dict[Any, Any], digests: Dict[str, str]):
+        self.journal.put_many(self.stage, self.run_key,
+                              {qid: {'input': digests[str(qid)], 'output': out} for qid, out in outputs.items()})
+
+
+class JournalWriter:
+    """RunWriter と同じ write(qid, ranked) で、ジャーナルへの追記と RUN ファイルへの書き出しを同時に行う。"""
+
+    def __init__(self, log: StageLog, digests: Dict[str, str], run_writer=None):
+        self.log = log
+        self.digests = digests
+        self.run_writer = run_writer
+
+    def write(self, qid, ranked):
+        self.log.put_many({qid: ranked}, self.digests)
+        if self.run_writer is not None:
+            self.run_writer.write(qid, ranked)
+
+
+def input_digest(*parts) -> str:
+    """1クエリ分のステージの入力のハッシュ。"""
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def stage_config(stage: str, dataset: str, args) -> Dict[str, Any]:
+    """ステージの結果を決める設定。BM25 は拡張に使う疑似参照文 (llm, 先頭 min(doc_gen, article_num) 件) にも依存する。"""
+    n_refs = min(args.doc_gen, args.article_num) if args.doc_gen > 0 else 0
+    config = {'dataset': dataset, 'llm': args.llm if n_refs else None, 'n_refs': n_refs}
+    config.update((p, getattr(args, p)) for p in BM25_PARAMS)
+    if stage == 'rerank':
+        config.update((p, getattr(args, p)) for p in RERANK_PARAMS)
+        config.update(llm=args.llm if args.doc_gen > 0 else None, doc_gen=args.doc_gen)
+        # カスケードなしの run_key は従来のまま (既存のジャーナルを無効にしない)
+        if args.cascade_model:
+            config.update(cascade_model=args.cascade_model, cascade_m=args.cascade_m)
+    return config
+
+
+def run_key(stage: str, dataset: str, args) -> str:
+    payload = json.dumps(stage_config(stage, dataset, args), sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def get_journal(path: str) -> StageJournal:
+    with _JOURNALS_LOCK:
+        if path not in _JOURNALS:
+            _JOURNALS[path] = StageJournal(path)
+        return _JOURNALS[path]
+
+
+def open_stage(args, stage: str, dataset: str):
+    """--no_journal なら None を返す。"""
+    if args.no_journal:
+        return None
+    return StageLog(get_journal(args.journal), stage, run_key(stage, dataset, args))
+
+
+def discard_dataset(args, dataset: str):
+    """--fresh: この設定・データセットの記録を捨てて最初からやり直す。"""
+    if args.no_journal:
+        return
+    journal = get_journal(args.journal)
+    n = sum(journal.discard(stage, run_key(stage, dataset, args)) for stage in STAGES)
+    if n:
+        logging.info(f"Discarded {n} journaled queries for {dataset} (--fresh)")
+
+
+def resume_rerank(retriever, rank_result: List[Any], gen_key: str, log: StageLog = None, run_writer=None, **kwargs):
+    """
+    ジャーナルに記録済みのクエリは読み出し、残りのクエリだけ retriever.rerank する。
+    記録済みのクエリを先に run_writer に書き、残りは1クエリ終わるごとにジャーナルと run_writer の両方に書く
+    (RUN ファイルの行の順序は変わるが、trec_eval は順序によらない)。戻り値は rank_result の順。
+    入力 (クエリ・使った疑似参照文・候補文書) が記録時と違うクエリはやり直す。
+    """
+    if log is None:
+        return retriever.rerank(rank_result, gen_key, run_writer=run_writer, **kwargs)
+    topk = kwargs.get('topk', 100)
+    digests = {
+        str(item.qid): input_digest(item.query, item.get(gen_key) or [], item.docids(topk),
+                                    kwargs.get('use_enhanced_query', False))
+        for item in rank_result
+    }
+    done = log.load(digests)
+    todo = [item for item in rank_result if str(item.qid) not in done]
+    if done:
+        logging.info(f"Resuming rerank: {len(rank_result) - len(todo)}/{len(rank_result)} queries already journaled")
+    for item in rank_result:
+        if item.qid and str(item.qid) in done and run_writer is not None:
+            run_writer.write(item.qid, [tuple(pair) for pair in done[str(item.qid)]])
+    new = retriever.rerank(todo, gen_key, run_writer=JournalWriter(log, digests, run_writer), **kwargs) if todo else {}
+    rerank_result = {}
+    for item in rank_result:
+        qid = item.qid
+        if not qid:
+            continue
+        ranked = new.get(qid)
+        if ranked is None:
+            if str(qid) not in done:
+                continue
+            ranked = [tuple(pair) for pair in done[str(qid)]]
+        rerank_result[qid] = ranked
+    return rerank_result
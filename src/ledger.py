@@ -0,0 +1,138 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import threading
+import argparse
+from contextlib import contextmanager
+from typing import Dict, Any, List
+
+
+class ResultsLedger:
+    """
+    評価結果の追記専用台帳 (SQLite)。
+    1データセットの評価ごとに1レコードを追記する。SQLite のトランザクションとロックにより、
+    複数の実験を並列に走らせても結果が上書きで消えることはない。
+    results/{irmode}.json 形式の集計は summary() で台帳から毎回作り直す。
+    """
+
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+                ' created REAL NOT NULL,'
+                ' irmode TEXT NOT NULL,'
+                ' llm TEXT NOT NULL,'
+                ' rank_model TEXT NOT NULL,'
+                ' mode TEXT NOT NULL,'
+                ' doc_gen INTEGER NOT NULL,'
+                ' dataset TEXT NOT NULL,'
+                ' metrics TEXT NOT NULL,'
+                ' timings TEXT NOT NULL,'
+                ' config TEXT NOT NULL)'
+            )
+
+    @contextmanager
+    def _connect(self):
+        # 接続は操作ごとに作る (書き込みは SQLite がロックで直列化する)
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def append(self, irmode: str, llm: str, rank_model: str, mode: str, doc_gen: int, dataset: str,
+               metrics: Dict[str, float], timings: Dict[str, float] = None, config: Dict[str, Any] = None):
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO results (created, irmode, llm, rank_model, mode, doc_gen, dataset, metrics, timings, config)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (time.time(), irmode, llm, rank_model, mode, int(doc_gen), dataset,
+                 json.dumps(metrics), json.dumps(timings or {}), json.dumps(config or {}, default=str))
+            )
+
+    def records(self, conn=None, **filters) -> List[Dict[str, Any]]:
+        """条件 (irmode=..., llm=... など) に合うレコードを古い順に返す。"""
+        if conn is None:
+            with self._connect() as conn:
+                return self.records(conn, **filters)
+        where = ' AND '.join(f'{k}=?' for k in filters)
+        sql = 'SELECT * FROM results' + (f' WHERE {where}' if where else '') + ' ORDER BY id'
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(sql, list(filters.values())).fetchall()
+        out = []
+        for row in rows:
+            rec = dict(row)
+            for key in ('metrics', 'timings', 'config'):
+                rec[key] = json.loads(rec[key])
+            out.append(rec)
+        return out
+
+    def summary(self, irmode: str, metric: str = 'ndcg_cut_10', conn=None) -> Dict[str, Any]:
+        """
+        従来の results/{irmode}.json と同じ {llm: {rank_model: {mode_nK: {dataset: score}}}} を作る。
+        同じ組み合わせが複数回あれば最新のレコードを使う。
+        """
+        summary: Dict[str, Any] = {}
+        for rec in self.records(conn, irmode=irmode):
+            key_mode = f"{rec['mode']}_n{rec['doc_gen']}"
+            node = summary.setdefault(rec['llm'], {}).setdefault(rec['rank_model'], {}).setdefault(key_mode, {})
+            node[rec['dataset']] = rec['metrics'].get(metric, 0.0)
+        return summary
+
+    def import_legacy_summary(self, irmode: str, path: str):
+        """台帳導入前の results/{irmode}.json を一度だけ取り込む (その irmode のレコードがない場合のみ)。"""
+        if not os.path.exists(path):
+            return
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if conn.execute('SELECT 1 FROM results WHERE irmode=? LIMIT 1', (irmode,)).fetchone():
+                return
+            with open(path, encoding='utf-8') as f:
+                legacy = json.load(f)
+            for llm, by_model in legacy.items():
+                for rank_model, by_mode in by_model.items():
+                    for key_mode, by_dataset in by_mode.items():
+                        mode, _, doc_gen = key_mode.rpartition('_n')
+                        for dataset, score in by_dataset.items():
+                            conn.execute(
+                                'INSERT INTO results (created, irmode, llm, rank_model, mode, doc_gen, dataset, metrics, timings, config)'
+                                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                (0.0, irmode, llm, rank_model, mode, int(doc_gen or 0), dataset,
+                                 json.dumps({'ndcg_cut_10': score}), '{}', json.dumps({'imported_from': path}))
+                            )
+
+    def export_summary(self, irmode: str, path: str, metric: str = 'ndcg_cut_10'):
+        """
+        集計ビューを一時ファイルに書いてから置き換える (読み手が途中状態を見ないように)。
+        書き込みロックを取ったまま読み出し・置き換えを行い、古いビューで上書きされないようにする。
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.summary(irmode, metric, conn), f, indent=4, ensure_ascii=False)
+            os.replace(tmp_path, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the nested summary view of a results ledger")
+    parser.add_argument('--ledger', type=str, default='results/ledger.sqlite')
+    parser.add_argument('--irmode', type=str, default='mugipipeline')
+    parser.add_argument('--metric', type=str, default='ndcg_cut_10')
+    args = parser.parse_args()
+    json.dump(ResultsLedger(args.ledger).summary(args.irmode, args.metric), sys.stdout, indent=4, ensure_ascii=False)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+_NULL = nullcontext()
+
+
+def peak_rss_mb() -> float:
+    """プロセスの最大常駐メモリ (MB)。取得できない環境では 0。"""
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB, macOS は byte 単位
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {'count': 0}
+    ordered = sorted(values)
+
+    def pick(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+    return {
+        'count': len(ordered), 'sum': sum(ordered), 'mean': sum(ordered) / len(ordered),
+        'p50': pick(50), 'p90': pick(90), 'p99': pick(99), 'max': ordered[-1],
+    }
+
+
+class Profiler:
+    """
+    パイプライン全体の計測 (区間の所要時間 + 数値サンプル) を集め、Chrome trace 形式の JSON に書き出す。
+    chrome://tracing や Perfetto でそのまま開ける。集計 (パーセンタイル, 最大 RSS) は metadata に入る。
+    無効時は enabled の確認だけで何も記録しない。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._events = []
+        self._samples: Dict[str, List[float]] = {}
+        self._threads = {}
+
+    def enable(self):
+        with self._lock:
+            self.enabled = True
+            self._origin = time.perf_counter()
+            self._events, self._samples, self._threads = [], {}, {}
+
+    def span(self, name: str, cat: str = 'stage', **args):
+        """with PROFILER.span('bm25', dataset='dl19'): ... の区間を記録する。"""
+        if not self.enabled:
+            return _NULL
+        return self._span(name, cat, args)
+
+    @contextmanager
+    def _span(self, name, cat, args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.complete(name, start, time.perf_counter() - start, cat, **args)
+
+    def complete(self, name: str, start: float, seconds: float, cat: str = 'stage', **args):
+        """perf_counter で測った区間を記録する (ループ内では span より軽い)。"""
+        if not self.enabled:
+            return
+        thread = threading.current_thread()
+        event = {
+            'name': name, 'cat': cat, 'ph': 'X', 'pid': os.getpid(), 'tid': thread.ident,
+            'ts': (start - self._origin) * 1e6, 'dur': seconds * 1e6, 'args': args,
+        }
+        with self._lock:
+            self._threads[(os.getpid(), thread.ident)] = thread.name
+            self._events.append(event)
+            self._samples.setdefault(f'{name}_sec', []).append(seconds)
+
+    def sample(self, metric: str, value: float):
+        """レイテンシやバッチサイズなどの数値を記録する (パーセンタイルで集計)。"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._samples.setdefault(metric, []).append(float(value))
+
+    def _origin_wall(self) -> float:
+        # perf_counter の基準はプロセスごとに違うので、プロセス間では壁時計に直して揃える
+        return time.time() - (time.perf_counter() - self._origin)
+
+    def export(self) -> Dict:
+        """記録した区間とサンプルを取り出して空にする (--shards のワーカーから親プロセスへ送る)。"""
+        if not self.enabled:
+            return {}
+        self.sample('worker_peak_rss_mb', peak_rss_mb())
+        with self._lock:
+            data = {'origin_wall': self._origin_wall(), 'events': self._events,
+                    'samples': self._samples, 'threads': self._threads}
+            self._events, self._samples, self._threads = [], {}, {}
+        return data
+
+    def merge(self, data: Dict):
+        """export() した他のプロセスの記録を取り込む (区間の時刻はこのプロセスの基準に合わせる)。"""
+        if not self.enabled or not data:
+            return
+        shift = (data['origin_wall'] - self._origin_wall()) * 1e6
+        with self._lock:
+            for event in data['events']:
+                self._events.append(dict(event, ts=event['ts'] + shift))
+            for metric, values in data['samples'].items():
+                self._samples.setdefault(metric, []).extend(values)
+            self._threads.update(data['threads'])
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            samples = {k: list(v) for k, v in self._samples.items()}
+        out = {metric: percentiles(values) for metric, values in sorted(samples.items())}
+        out['peak_rss_mb'] = {'max': peak_rss_mb()}
+        return out
+
+    def save(self, path: str):
+        if not self.enabled:
+            return
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        summary = self.summary()
+        with self._lock:
+            events = list(self._events)
+            threads = dict(self._threads)
+        pid = os.getpid()
+        events += [{'name': 'thread_name', 'ph': 'M', 'pid': thread_pid, 'tid': tid, 'args': {'name': name}}
+                   for (thread_pid, tid), name in threads.items()]
+        events += [{'name': 'process_name', 'ph': 'M', 'pid': other, 'tid': 0, 'args': {'name': f'worker {other}'}}
+                   for other in sorted({thread_pid for thread_pid, _ in threads} - {pid})]
+        events.append({'name': 'peak_rss_mb', 'ph': 'C', 'pid': pid, 'tid': 0,
+                       'ts': (time.perf_counter() - self._origin) * 1e6,
+                       'args': {'rss': summary['peak_rss_mb']['max']}})
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'metadata': summary}, f)
+
+
+# プロセス全体で1つ (--profile で有効化)
+PROFILER = Profiler()
@@ -0,0 +1,60 @@
+import time
+import random
+import threading
+from collections import deque
+
+
+class RateLimiter:
+    """
+    OpenAI API 用のスレッドセーフなレート制御。
+    - tokens_per_minute: 直近60秒の消費トークン数の上限 (None なら無制限)
+    - 429 を受けたら全ワーカー共通のクールダウンを指数的に延ばし、成功したら縮める
+    """
+
+    WINDOW = 60.0
+
+    def __init__(self, tokens_per_minute=None, base_delay=1.0, max_delay=60.0):
+        self.tokens_per_minute = tokens_per_minute
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._delay = base_delay
+        self._pause_until = 0.0
+        self._events = deque()  # [timestamp, tokens]
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens):
+        """予算が空くまで待ち、予約エントリを返す (後で settle で実使用量に補正)。"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = self._pause_until - now
+                if wait <= 0 and self.tokens_per_minute:
+                    while self._events and now - self._events[0][0] >= self.WINDOW:
+                        self._events.popleft()
+                    used = sum(t for _, t in self._events)
+                    # 1リクエストで予算を超える場合は窓が空になれば通す
+                    if self._events and used + tokens > self.tokens_per_minute:
+                        wait = self.WINDOW - (now - self._events[0][0])
+                if wait <= 0:
+                    entry = [now, tokens]
+                    if self.tokens_per_minute:
+                        self._events.append(entry)
+                    return entry
+            time.sleep(min(wait, self.max_delay))
+
+    def settle(self, entry, tokens):
+        """予約したトークン数を実際の使用量で置き換える。"""
+        with self._lock:
+            entry[1] = tokens
+
+    def on_rate_limit(self, retry_after=None):
+        """429 を受けた際のバックオフ。Retry-After があればそれを優先する。"""
+        with self._lock:
+            delay = retry_after if retry_after else self._delay * (1 + random.random())
+            self._pause_until = max(self._pause_until, time.monotonic() + delay)
+            self._delay = min(self._delay * 2, self.max_delay)
+        return delay
+
+    def on_success(self):
+        with self._lock:
+            self._delay = max(self.base_delay, self._delay / 2)
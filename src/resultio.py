@@ -0,0 +1,207 @@
+import os
+import io
+import json
+import gzip
+import logging
+import argparse
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FORMAT_NAME = 'genqer-results'
+FORMAT_VERSION = 1
+# --result_format の選択肢 (json は従来の indent=4 の一括 JSON)
+RESULT_FORMATS = ['jsonl', 'jsonl.gz', 'jsonl.zst', 'json']
+_DOC_PREFIX = '{"type": "doc"'
+
+
+def open_text(path: str, mode: str = 'r'):
+    """拡張子 (.gz / .zst) に応じて圧縮ストリームをテキストモードで開く。"""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError("zstandard is required for .zst results (pip install zstandard)")
+        if mode == 'w':
+            raw = zstandard.ZstdCompressor(level=6).stream_writer(open(path, 'wb'), closefd=True)
+        else:
+            raw = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+        return io.TextIOWrapper(raw, encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def result_path(base: str, fmt: str) -> str:
+    """拡張子なしのパスに --result_format の拡張子を付ける。"""
+    return f"{base}.{fmt}"
+
+
+def strip_result_ext(path: str) -> str:
+    """'x.jsonl.gz' / 'x.json' などから結果ファイルの拡張子を取り除く。"""
+    for fmt in sorted(RESULT_FORMATS, key=len, reverse=True):
+        if path.endswith('.' + fmt):
+            return path[:-len(fmt) - 1]
+    return os.path.splitext(path)[0]
+
+
+class ResultWriter:
+    """
+    結果を1クエリ1行の JSON Lines で逐次書き出す (拡張子 .gz / .zst なら圧縮)。
+      {"type": "header", "format": ..., "version": 1, "index": ...}
+      {"type": "doc", "docid": ..., "content": ...}      各文書の本文はファイル内で1回だけ
+      {"type": "query", "qid": ..., "query": ..., <疑似参照文など>, "hits": [{"docid", "rank", "score"}]}
+    hit は docid で本文を参照する。with_text=False なら本文は書かず、iter_results がヘッダの index から引く。
+    """
+
+    def __init__(self, path: str, index_name: str = None, with_text: bool = True):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.with_text = with_text
+        self.queries = 0
+        self._seen = set()
+        self._f = open_text(path, 'w')
+        self._line({'type': 'header', 'format': FORMAT_NAME, 'version': FORMAT_VERSION,
+                    'index': index_name, 'with_text': with_text})
+
+    def _line(self, record: Dict[str, Any]):
+        self._f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def write(self, entry: Dict[str, Any]):
+        """従来の JSON と同じ形のエントリ (hits に content を含んでもよい) を1件書く。"""
+        hits = []
+        for hit in entry.get('hits', []):
+            docid = str(hit.get('docid'))
+            if self.with_text and docid not in self._seen and 'content' in hit:
+                self._seen.add(docid)
+                self._line({'type': 'doc', 'docid': docid, 'content': hit['content']})
+            hits.append({'docid': docid, 'rank': hit.get('rank'), 'score': hit.get('score')})
+        qid = entry.get('qid') or (entry.get('hits') or [{}])[0].get('qid')
+        record = {'type': 'query', 'qid': None if qid is None else str(qid)}
+        record.update((k, v) for k, v in entry.items() if k not in ('hits', 'qid'))
+        record['hits'] = hits
+        self._line(record)
+        self.queries += 1
+
+    def close(self):
+        if not self._f.closed:
+            self._f.close()
+            logging.info(f"Wrote results: {self.path} ({self.queries} queries, {len(self._seen)} docs)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_results(path: str, with_content: bool = True,
+                 doc_lookup: Optional[Callable[[List[str]], List[str]]] = None) -> Iterator[Dict[str, Any]]:
+    """
+    結果ファイルのエントリを1クエリずつ返す (従来の JSON と同じ形: hits に qid / content を持つ)。
+    JSON Lines は逐次読み込み、従来の一括 JSON はそのまま読み込んで同じ形で返す。
+    本文を持たないファイル (--no_result_text) で with_content=True の場合は doc_lookup(docids) で本文を引く。
+    doc_lookup がなければヘッダの index の文書キャッシュ (docstore.get_doc_cache) から引く。
+    """
+    header = read_header(path)
+    if not header:
+        # 従来の indent=4 の JSON
+        with open_text(path) as f:
+            data = json.load(f)
+        if not isinstance(data, list):
+            raise ValueError(f"{path} is not a result list")
+        yield from data
+        return
+
+    if with_content and doc_lookup is None and not header.get('with_text', True):
+        if not header.get('index'):
+            raise ValueError(f"{path} has no document text and no index in its header; "
+                             f"pass doc_lookup or read with with_content=False")
+        from src import docstore
+        doc_lookup = docstore.get_doc_cache(header['index']).get_many
+
+    texts: Dict[str, str] = {}
+    with open_text(path) as f:
+        f.readline()
+        for line in f:
+            # 本文が不要なら文書行はパースせずに飛ばす (ResultWriter は type を先頭に書く)
+            if not with_content and line.startswith(_DOC_PREFIX):
+                continue
+            record = json.loads(line)
+            kind = record.pop('type', None)
+            if kind == 'doc':
+                if with_content:
+                    texts[record['docid']] = record['content']
+                continue
+            if kind != 'query':
+                continue
+            qid = record.get('qid')
+            if with_content and doc_lookup is not None:
+                missing = [h['docid'] for h in record['hits'] if h['docid'] not in texts]
+                if missing:
+                    texts.update(zip(missing, doc_lookup(missing)))
+            for hit in record['hits']:
+                hit['qid'] = qid
+                if with_content:
+                    hit['content'] = texts.get(hit['docid'], '')
+            yield record
+
+
+def read_header(path: str) -> Dict[str, Any]:
+    """JSON Lines 形式ならヘッダを、従来の JSON なら空の dict を返す。"""
+    with open_text(path) as f:
+        first = f.readline()
+    if not first.lstrip().startswith('{'):
+        return {}
+    try:
+        header = json.loads(first)
+    except ValueError:
+        return {}
+    return header if isinstance(header, dict) and header.get('format') == FORMAT_NAME else {}
+
+
+def convert_legacy(json_path: str, out_path: str, index_name: str = None, with_text: bool = True) -> int:
+    """従来の一括 JSON (exp/ 以下) を JSON Lines 形式に変換する。変換したクエリ数を返す。"""
+    with ResultWriter(out_path, index_name=index_name, with_text=with_text) as writer:
+        for entry in iter_results(json_path):
+            writer.write(entry)
+        return writer.queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert legacy result JSON files under exp/ to JSON Lines")
+    parser.add_argument('paths', nargs='+', help='Legacy .json files or directories (searched recursively)')
+    parser.add_argument('--format', choices=[f for f in RESULT_FORMATS if f != 'json'], default='jsonl.gz')
+    parser.add_argument('--index', type=str, default=None, help='Index name recorded in the header')
+    parser.add_argument('--no_text', action='store_true', help='Drop document text (resolved from the index on read)')
+    parser.add_argument('--delete', action='store_true', help='Remove each legacy file after a successful conversion')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    files = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, n) for n in sorted(names) if n.endswith('.json'))
+        else:
+            files.append(path)
+    for path in files:
+        out_path = result_path(strip_result_ext(path), args.format)
+        try:
+            n = convert_legacy(path, out_path, args.index, with_text=not args.no_text)
+        except ValueError as e:
+            # 結果ファイル以外の JSON (meta.json など) は飛ばす
+            logging.warning(f"Skipping {path}: {e}")
+            if os.path.exists(out_path):
+                os.remove(out_path)
+            continue
+        logging.info(f"{path} -> {out_path} ({n} queries, {os.path.getsize(path) / 1e6:.1f} MB -> "
+                     f"{os.path.getsize(out_path) / 1e6:.1f} MB)")
+        if args.delete:
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,19 @@
+import time
+import hashlib
+import logging
+import threading
+import numpy as np
 import torch
 import torch.nn.functional as F
 from transformers import AutoTokenizer, AutoModel
 from tqdm import tqdm
 from typing import List, Dict
+from src.embstore import EmbeddingStore
+from src.profiler import PROFILER
+from src.hits import QueryHits, to_query_hits
+
+# クエリ側埋め込みのストア名 (文書側はインデックス名ごと)
+QUERY_NAMESPACE = '_queries'
 
 TASK_DESC = 'Given a web search query, retrieve relevant passages that answer the query'
 
@@ -10,25 +21,154 @@ def mean_pooling(last_hidden_states: torch.Tensor, attention_mask: torch.Tensor)
     input_mask_expanded = attention_mask.unsqueeze(-1).expand(last_hidden_states.size()).float()
     return torch.sum(last_hidden_states * input_mask_expanded, 1) / torch.clamp(input_mask_expanded.sum(1), min=1e-9)
 
+INFERENCE_BACKENDS = ['fp32', 'int8', 'bf16', 'compile']
+
 class NeuralRetriever:
-    def __init__(self, model_name, mode):
+    def __init__(self, model_name, mode, emb_cache=None, max_batch_tokens=16384, inference='fp32'):
+        if inference not in INFERENCE_BACKENDS:
+            raise ValueError(f"Unknown inference backend: {inference}")
         self.model_name = model_name
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.inference = inference
+        # int8 動的量子化は CPU のみ対応
+        self.device = "cuda" if torch.cuda.is_available() and inference != 'int8' else "cpu"
         self.model = AutoModel.from_pretrained(model_name).to(self.device)
         self.model.eval()
+        if inference == 'int8':
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        elif inference == 'compile':
+            self.model = torch.compile(self.model, dynamic=True)
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
         self.mode = mode
+        # 文書埋め込みの永続キャッシュ (None なら無効)。インデックスごとに分ける
+        self.emb_cache = emb_cache
+        self._doc_stores = {}
+        self._store_lock = threading.Lock()
+        # 1バッチあたりのトークン数上限 (最大長 x 件数)
+        self.max_batch_tokens = max_batch_tokens
+
+    def _store(self, namespace):
+        if not self.emb_cache or not namespace:
+            return None
+        with self._store_lock:
+            if namespace not in self._doc_stores:
+                # 低精度バックエンドの埋め込みは fp32 のものと混ぜない
+                store_model = self.model_name if self.inference in ('fp32', 'compile') else f"{self.model_name}@{self.inference}"
+                self._doc_stores[namespace] = EmbeddingStore(self.emb_cache, store_model, namespace)
+            return self._doc_stores[namespace]
+
+    def doc_store(self, index_name):
+        return self._store(index_name)
+
+    def query_store(self):
+        """クエリ側の埋め込みはインデックスによらず、テキストのハッシュをキーに1つのストアで共有する。"""
+        return self._store(QUERY_NAMESPACE)
+
+    def embed_queries(self, texts: List[str]) -> torch.Tensor:
+        """
+        クエリ側のテキスト (contex-pool なら q + " " + r) を埋め込む。
+        同じテキストはバッチ内で1回だけエンコードし、キャッシュ済みのテキストはエンコードしない。
+        """
+        unique = list(dict.fromkeys(texts))
+        store = self.query_store()
+        if store is None:
+            embeds = self.embed_many(unique)
+        else:
+            keys = [hashlib.sha1(t.encode('utf-8')).hexdigest() for t in unique]
+            rows = store.lookup(keys)
+            missing = [i for i, row in enumerate(rows) if row is None]
+            if missing:
+                new_embeds = self.embed_many([unique[i] for i in missing])
+                store.add([keys[i] for i in missing], new_embeds.float().cpu().numpy())
+                rows = store.lookup(keys)
+            embeds = torch.from_numpy(store.vectors(rows)).to(self.device)
+            PROFILER.sample('query_cache_hit_ratio', 1.0 - len(missing) / max(1, len(unique)))
+        PROFILER.sample('query_dedup_ratio', 1.0 - len(unique) / max(1, len(texts)))
+        if len(unique) == len(texts):
+            return embeds
+        position = {t: i for i, t in enumerate(unique)}
+        return embeds[torch.tensor([position[t] for t in texts], device=embeds.device)]
+
+    def embed_docs(self, docids, contents, index_name=None):
+        """文書を埋め込む。キャッシュにある文書は読み出し、未登録の文書だけエンコードする。"""
+        store = self.doc_store(index_name)
+        if store is None:
+            return self._embed_timed(contents, cached=0)
+
+        rows = store.lookup(docids)
+        missing = [i for i, row in enumerate(rows) if row is None]
+        if missing:
+            new_embeds = self._embed_timed([contents[i] for i in missing], cached=len(docids) - len(missing))
+            store.add([docids[i] for i in missing], new_embeds.float().cpu().numpy())
+            rows = store.lookup(docids)
+        return torch.from_numpy(store.vectors(rows)).to(self.device)
+
+    def _embed_timed(self, contents, cached):
+        if not PROFILER.enabled:
+            return self.embed_many(contents)
+        start = time.perf_counter()
+        embeds = self.embed_many(contents)
+        elapsed = time.perf_counter() - start
+        PROFILER.complete('encode_docs', start, elapsed, 'encoder', docs=len(contents), cached=cached)
+        PROFILER.sample('encoder_docs_per_sec', len(contents) / elapsed if elapsed > 0 else 0.0)
+        return embeds
 
     def embed(self, input_texts):
         # 元のreranker.pyのロジックをそのまま利用
         input_tokens = self.tokenizer(input_texts, padding=True, truncation=True, return_tensors='pt').to(self.device)
-        with torch.no_grad():
+        return self._encode(input_tokens)
+
+    def embed_many(self, input_texts: List[str]) -> torch.Tensor:
+        """
+        大量のテキストをトークン長でソートし、(最大長 x 件数) が max_batch_tokens 以下の
+        バッチに分けてエンコードする。結果は入力順に並べ直して返す。
+        """
+        if not input_texts:
+            return torch.empty(0, self.model.config.hidden_size, device=self.device)
+        encoded = self.tokenizer(list(input_texts), truncation=True)['input_ids']
+        order = sorted(range(len(encoded)), key=lambda i: len(encoded[i]), reverse=True)
+
+        batches, current = [], []
+        for i in order:
+            # 長い順に並べているので、バッチの最大長は先頭の長さ
+            if current and len(encoded[current[0]]) * (len(current) + 1) > self.max_batch_tokens:
+                batches.append(current)
+                current = []
+            current.append(i)
+        if current:
+            batches.append(current)
+
+        embeddings = None
+        for batch in batches:
+            input_tokens = self.tokenizer.pad(
+                {'input_ids': [encoded[i] for i in batch]}, padding=True, return_tensors='pt'
+            ).to(self.device)
+            if PROFILER.enabled:
+                start = time.perf_counter()
+                batch_embeds = self._encode(input_tokens)
+                if self.device == 'cuda':
+                    torch.cuda.synchronize()
+                rows, width = input_tokens['input_ids'].shape
+                real = sum(len(encoded[i]) for i in batch)
+                PROFILER.complete('encode_batch', start, time.perf_counter() - start, 'encoder', rows=rows, width=width)
+                PROFILER.sample('encoder_batch_size', rows)
+                PROFILER.sample('encoder_padding_ratio', 1.0 - real / max(1, rows * width))
+            else:
+                batch_embeds = self._encode(input_tokens)
+            if embeddings is None:
+                embeddings = torch.empty(len(input_texts), batch_embeds.shape[1],
+                                         dtype=batch_embeds.dtype, device=batch_embeds.device)
+            embeddings[torch.tensor(batch, device=batch_embeds.device)] = batch_embeds
+        return embeddings
+
+    def _encode(self, input_tokens):
+        with torch.no_grad(), torch.autocast(device_type=self.device, dtype=torch.bfloat16,
+                                             enabled=self.inference == 'bf16'):
             outputs = self.model(**input_tokens)
             if "bge" in self.model_name.lower():
                 embeddings = outputs[0][:, 0]
             else:
                 embeddings = mean_pooling(outputs.last_hidden_state, input_tokens['attention_mask'])
-            embeddings = F.normalize(embeddings, p=2, dim=-1)
+        embeddings = F.normalize(embeddings.float(), p=2, dim=-1)
         return embeddings
 
     def _enhance_query_text(self, q, refs):
@@ -39,49 +179,198 @@ class NeuralRetriever:
             return q + (refs[0] if refs else "")
         return q
 
-    def rerank(self, rank_result: List[Dict], gen_key: str, topk=100, use_enhanced_query=False):
+    def _query_texts(self, item, gen_key, use_enhanced_query):
+        """クエリ側でエンコードするテキストのリストを返す。"""
+        q = item.get("query", "")
+        refs = (item.get(gen_key) or []) if use_enhanced_query else []
+
+        # Context-Pool Implementation: クエリと各参照文のペアを作成
+        if use_enhanced_query and self.mode == 'contex-pool':
+            return [q + " " + r for r in refs] or [q]
+        # 既存のモード
+        return [self._enhance_query_text(q, refs) if use_enhanced_query else q]
+
+    def encode_queries(self, items, gen_key: str, use_enhanced_query=False) -> torch.Tensor:
+        """
+        各クエリの検索用ベクトル (len(items), dim) を返す。
+        contex-pool ではクエリと各参照文のペアの埋め込みを平均して正規化する。
+        """
+        query_texts, spans = [], []
+        for item in items:
+            texts = self._query_texts(item, gen_key, use_enhanced_query)
+            spans.append((len(query_texts), len(query_texts) + len(texts)))
+            query_texts.extend(texts)
+        query_embeds = self.embed_queries(query_texts)
+        if not (use_enhanced_query and self.mode == 'contex-pool'):
+            return query_embeds
+        pooled = []
+        for s, e in spans:
+            # 平均化して正規化
+            query_embed = torch.mean(query_embeds[s:e], dim=0, keepdim=True)
+            pooled.append(F.normalize(query_embed, p=2, dim=1))
+        return torch.cat(pooled) if pooled else query_embeds
+
+    def rerank(self, rank_result: List[Dict], gen_key: str, topk=100, use_enhanced_query=False,
+               index_name=None, query_chunk=64, run_writer=None):
+        """
+        query_chunk 件のクエリごとに、クエリ側・文書側のテキストをまとめてエンコードしてから
+        クエリごとにスコアリングする (長さ別のバッチングがクエリをまたいで効くようにするため)。
+        戻り値は {qid: [(docid, 密スコア), ...]} (スコア降順の全候補)。
+        run_writer を渡すとクエリごとに TREC RUN 形式で書き出す。
+        rank_result は QueryHits のリスト (従来の dict 形式も可)。
+        """
+        rank_result = to_query_hits(rank_result)
         rerank_result = {}
-        
-        for item in tqdm(rank_result, desc="Reranking"):
-            q = item.get("query", "")
-            
-            # Context-Pool Implementation
-            if use_enhanced_query and self.mode == 'contex-pool':
-                refs = item.get(gen_key) or []
-                # クエリと各参照文のペアを作成
-                enhanced_queries = [q + " " + r for r in refs]
-                if not enhanced_queries: enhanced_queries = [q]
-                
-                # バッチエンコードして平均化
-                all_embeddings = self.embed(enhanced_queries)
-                query_embed = torch.mean(all_embeddings, dim=0, keepdim=True)
-                query_embed = F.normalize(query_embed, p=2, dim=1)
-            
-            # 既存のモード
-            else:
-                if use_enhanced_query:
-                    refs = item.get(gen_key) or []
-                    query_text = self._enhance_query_text(q, refs)
-                else:
-                    query_text = q
-                query_embed = self.embed(query_text)
-
-            # ドキュメントのエンコードとスコアリング
-            current_hits = item['hits'][:topk]
-            if not current_hits: continue
-            
-            docs = [hit['content'] for hit in current_hits]
-            docs_idx = [hit['docid'] for hit in current_hits]
-            
-            hits_embed = self.embed(docs)
-            scores = torch.matmul(query_embed, hits_embed.T)
-            
-            # Top-10 取得
-            _, indices = scores.topk(min(10, len(docs)), dim=1)
-            selected_doc_ids = [docs_idx[i] for i in indices.reshape(-1).tolist()]
-            
-            # QIDをキーに保存
-            qid = item['hits'][0]['qid'] if item['hits'] else item.get('qid')
-            if qid: rerank_result[qid] = selected_doc_ids
-            
-        return rerank_result
\ No newline at end of file
+
+        with tqdm(total=len(rank_result), desc="Reranking") as pbar:
+            for start in range(0, len(rank_result), query_chunk):
+                chunk = rank_result[start:start + query_chunk]
+                chunk_start = time.perf_counter()
+
+                # クエリ側: 全クエリのテキストを一括エンコード (重複とキャッシュ済みのテキストは除く)
+                query_vectors = self.encode_queries(chunk, gen_key, use_enhanced_query)
+
+                # 文書側: チャンク内で重複を除いて一括エンコード
+                doc_rows, docids, contents = {}, [], []
+                for item in chunk:
+                    for docid, content in zip(item.docids(topk), item.contents(topk)):
+                        if docid not in doc_rows:
+                            doc_rows[docid] = len(docids)
+                            docids.append(docid)
+                            contents.append(content)
+                doc_embeds = self.embed_docs(docids, contents, index_name)
+
+                for i, item in enumerate(chunk):
+                    pbar.update(1)
+                    # ドキュメントのスコアリング
+                    docs_idx = item.docids(topk)
+                    if not docs_idx: continue
+
+                    query_embed = query_vectors[i:i + 1]
+
+                    hits_embed = doc_embeds[[doc_rows[d] for d in docs_idx]]
+                    scores = torch.matmul(query_embed, hits_embed.T.to(query_embed.dtype))
+
+                    # 全候補を密スコア順に並べる
+                    values, indices = torch.sort(scores.reshape(-1), descending=True)
+                    ranked = [(docs_idx[i], v) for i, v in zip(indices.tolist(), values.float().tolist())]
+
+                    # QIDをキーに保存し、RUNファイルにも逐次書き出す
+                    qid = item.qid
+                    if qid:
+                        rerank_result[qid] = ranked
+                        if run_writer is not None:
+                            run_writer.write(qid, ranked)
+
+                # クエリはチャンク単位でまとめて処理するため、1クエリあたりは均等割りの値
+                elapsed = time.perf_counter() - chunk_start
+                PROFILER.complete('rerank_chunk', chunk_start, elapsed, 'rerank', queries=len(chunk), docs=len(docids))
+                PROFILER.sample('rerank_query_sec', elapsed / len(chunk))
+
+        return rerank_result
+
+
+class CascadeRetriever:
+    """
+    2段のカスケード rerank。軽いエンコーダ (first) で BM25 の上位 topk 件を全てスコアリングし、
+    上位 m 件だけを重いエンコーダ (final, --rank_model) でスコアリングし直す。
+    NeuralRetriever.rerank と同じ引数・戻り値なので、ジャーナルやシャードからそのまま使える。
+    """
+
+    # 両モデルとも埋め込みを L2 正規化しているのでスコア (コサイン) は [-1, 1]。
+    # 第1段だけの候補をこれだけ下げると、第1段の順序のまま必ず第2段の候補より下に並ぶ (trec_eval はスコア順)
+    TAIL_OFFSET = 2.0
+
+    def __init__(self, first: NeuralRetriever, final: NeuralRetriever, m=20):
+        # sweep のグリッドは argparse を通らないのでここでも確かめる
+        if m < 1:
+            raise ValueError(f"Cascade needs at least one candidate per query for the final model (m={m})")
+        self.first = first
+        self.final = final
+        self.m = m
+
+    def rerank(self, rank_result: List[Dict], gen_key: str, topk=100, use_enhanced_query=False,
+               index_name=None, query_chunk=64, run_writer=None, stats=None):
+        """
+        戻り値は {qid: [(docid, スコア), ...]}。先頭 m 件は final のスコア順、残りは first の順位のまま。
+        stats (dict) を渡すと段ごとの所要時間と文書数を足し込む。
+        """
+        rank_result = to_query_hits(rank_result)
+        start = time.perf_counter()
+        first = self.first.rerank(rank_result, gen_key, topk=topk, use_enhanced_query=use_enhanced_query,
+                                  index_name=index_name, query_chunk=query_chunk)
+        first_sec = time.perf_counter() - start
+        PROFILER.complete('cascade_first', start, first_sec, 'rerank', model=self.first.model_name,
+                          queries=len(rank_result))
+
+        # 第1段の上位 m 件だけを残した QueryHits (文書テーブルは元のものを共有する)
+        survivors = []
+        for item in rank_result:
+            ranked = first.get(item.qid)
+            if not ranked:
+                continue
+            head = ranked[:self.m]
+            rows = np.fromiter((item.table.row(d) for d, _ in head), dtype=np.int32, count=len(head))
+            scores = np.fromiter((s for _, s in head), dtype=np.float32, count=len(head))
+            survivors.append(QueryHits(item.qid, item.query, rows, scores, item.table, item.extra))
+
+        start = time.perf_counter()
+        final = self.final.rerank(survivors, gen_key, topk=self.m, use_enhanced_query=use_enhanced_query,
+                                  index_name=index_name, query_chunk=query_chunk)
+        final_sec = time.perf_counter() - start
+        PROFILER.complete('cascade_final', start, final_sec, 'rerank', model=self.final.model_name,
+                          queries=len(survivors))
+
+        rerank_result = {}
+        for item in survivors:
+            qid = item.qid
+            ranked = final[qid] + [(d, s - self.TAIL_OFFSET) for d, s in first[qid][self.m:]]
+            rerank_result[qid] = ranked
+            if run_writer is not None:
+                run_writer.write(qid, ranked)
+
+        if stats is not None:
+            for key, value in (('cascade_first_sec', first_sec), ('cascade_final_sec', final_sec),
+                               ('cascade_first_docs', sum(len(ranked) for ranked in first.values())),
+                               ('cascade_final_docs', sum(len(item) for item in survivors))):
+                stats[key] = stats.get(key, 0) + value
+        logging.info(f"Cascade: {self.first.model_name} scored {len(rank_result)} queries in {first_sec:.1f}s, "
+                     f"{self.final.model_name} rescored top-{self.m} in {final_sec:.1f}s")
+        return rerank_result
+
+
+def check_inference_drift(candidate: NeuralRetriever, reference: NeuralRetriever, rank_result: List[Dict],
+                          gen_key: str, qrels_path: str, n_queries=20, topk=100, use_enhanced_query=True):
+    """
+    低精度バックエンド (candidate) と fp32 (reference) を先頭 n_queries 件のクエリで比較し、
+    埋め込みのコサインのずれ (1 - cos) と nDCG@10 の差を返す。キャッシュは使わない。
+    """
+    from src.evaluation import Evaluator
+
+    sample = [item for item in to_query_hits(rank_result) if len(item)][:n_queries]
+    texts = []
+    for item in sample:
+        texts.extend(reference._query_texts(item, gen_key, use_enhanced_query))
+        texts.extend(item.contents(topk))
+    if not texts:
+        return {}
+    cos = (candidate.embed_many(texts).cpu() * reference.embed_many(texts).cpu()).sum(dim=-1)
+    drift = 1.0 - cos
+
+    report = {
+        'queries': len(sample),
+        'texts': len(texts),
+        'cosine_drift_mean': float(drift.mean()),
+        'cosine_drift_max': float(drift.max()),
+    }
+    if qrels_path:
+        qids = [str(item.qid) for item in sample]
+        scores = {}
+        for name, retriever in (('candidate', candidate), ('reference', reference)):
+            run = retriever.rerank(sample, gen_key, topk=topk, use_enhanced_query=use_enhanced_query)
+            run = {str(qid): ranked for qid, ranked in run.items()}
+            per_query = Evaluator.evaluate(run, qrels_path, metrics=('ndcg_cut.10',), per_query=True)['ndcg_cut_10']
+            scores[name] = sum(per_query.get(qid, 0.0) for qid in qids) / max(1, len(qids))
+        report['ndcg@10_reference'] = scores['reference']
+        report['ndcg@10_delta'] = scores['candidate'] - scores['reference']
+    return report
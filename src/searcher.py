@@ -1,28 +1,68 @@
+import time
+import queue
 import logging
-import json
+import threading
+from collections import Counter
 from tqdm import tqdm
-from pyserini.search.lucene import LuceneSearcher
-from pyserini.search import get_topics, get_qrels
-from src import benchmark
+from src import benchmark, docstore, snapshot
 from src.prompts import PromptManager
+from src.profiler import PROFILER
+from src.hits import DocTable, build_query_hits
+from src.journal import input_digest, open_stage
 from src.utils import dump_json, load_json
 import os
 
+# Lucene の BooleanQuery の節数上限 (IndexSearcher.maxClauseCount の既定値)
+MAX_CLAUSES = 1024
+# ジャーナル使用時に1回で検索・記録するクエリ数
+JOURNAL_CHUNK = 256
+
+
 class SparseSearcher:
     
     @staticmethod
     def get_data_pyserini(data, test=False):
-        searcher = LuceneSearcher.from_prebuilt_index(benchmark.THE_INDEX[data])
-        topics = get_topics(benchmark.THE_TOPICS[data] if data != 'dl20' else 'dl20')
-        qrels = get_qrels(benchmark.THE_TOPICS[data])
+        searcher = docstore.get_searcher(benchmark.THE_INDEX[data])
+        topics, qrels = SparseSearcher.get_topics_qrels(data, test)
+        return searcher, topics, qrels
+
+    @staticmethod
+    def get_topics_qrels(data, test=False):
+        """判定のあるトピックと qrels。LuceneSearcher (JVM) は開かない。"""
+        # topics / qrels はローカルのスナップショットから読む (初回だけ pyserini から取得)
+        topics = snapshot.get_topics(snapshot.topics_name(data))
+        qrels = snapshot.get_qrels(benchmark.THE_TOPICS[data])
         topics = {k: v for k, v in topics.items() if k in qrels}
         if test:
             topics = {key: topics[key] for key in list(topics)[:10]}
-        return searcher, topics, qrels
+        return topics, qrels
+
+    @staticmethod
+    def gen_key_for(llm):
+        """生成文のキー名 (ex: gen_cand_gpt4)"""
+        return f'gen_cand_{llm}' if 'gpt' not in llm else 'gen_cand_gpt4'
+
+    @staticmethod
+    def add_pseudo_docs(topics, generator, prompt_manager, gen_key, n):
+        """各トピックに n 個の疑似参照文を topics[qid][gen_key] として追加する。"""
+        # クエリごとのプロンプトを作成
+        keys = list(topics)
+        requests = []
+        for key in keys:
+            query = topics[key]['title']
+            requests.append((prompt_manager.get_prompt(query), query))
+
+        # 指定回数生成 (キャッシュ済みのサンプルは再利用し、不足分を並列に生成)
+        outputs = generator.generate_many(requests, n)
+        for key, samples in zip(keys, outputs):
+            topics[key][gen_key] = samples
 
     @staticmethod
-    def get_results_with_generation(dataset, generator, prompt_manager, args):
-        """Executes generation (if needed) and sparse retrieval."""
+    def get_results_with_generation(dataset, generator, prompt_manager, args, retriever=None):
+        """
+        Executes generation (if needed) and sparse retrieval.
+        --irmode mugidense では BM25 の代わりに retriever でコーパス全体から密ベクトル検索する。
+        """
         
         # 1. Load Data
         searcher, topics, qrels = SparseSearcher.get_data_pyserini(dataset, args.test)
@@ -30,31 +70,38 @@ class SparseSearcher:
         # 2. Generate Pseudo References
         gen_key = None
         if generator:
-            gen_key = f'gen_cand_{args.llm}' if 'gpt' not in args.llm else 'gen_cand_gpt4'
+            gen_key = SparseSearcher.gen_key_for(args.llm)
             logging.info(f"Generating pseudo-docs for {dataset} using {args.llm}...")
-            
-            for key in tqdm(topics, desc="Generating"):
-                # クエリの取得
-                query = topics[key]['title']
-                # プロンプトの取得
-                messages = prompt_manager.get_prompt(query)
-                
-                topics[key].setdefault(gen_key, [])
-                # 指定回数生成
-                current_count = len(topics[key][gen_key])
-                if current_count < args.doc_gen:
-                    for _ in range(args.doc_gen - current_count):
-                        output = generator.generate(messages).strip()
-                        topics[key][gen_key].append(output)
+            with PROFILER.span('generation', dataset=dataset, queries=len(topics)):
+                SparseSearcher.add_pseudo_docs(topics, generator, prompt_manager, gen_key, args.doc_gen)
         
         # 3. Run BM25
-        return SparseSearcher.bm25_search(args, topics, searcher, qrels, gen_key)
+        doc_cache = docstore.get_doc_cache(
+            benchmark.THE_INDEX[dataset], capacity=args.doc_cache_size,
+            disk_path=None if args.no_doc_cache else args.doc_cache,
+            threads=args.bm25_threads
+        )
+        if args.irmode == 'mugidense':
+            from src import ann
+            with PROFILER.span('dense_search', dataset=dataset, queries=len(topics)):
+                return ann.dense_search(args, topics, retriever, searcher, benchmark.THE_INDEX[dataset], gen_key, doc_cache)
+        with PROFILER.span('bm25', dataset=dataset, queries=len(topics)):
+            return SparseSearcher.bm25_search(args, topics, searcher, qrels, gen_key, doc_cache,
+                                              journal=open_stage(args, 'bm25', dataset))
 
     @staticmethod
-    def bm25_search(args, topics, searcher, qrels, gen_key=None):
-        """Runs BM25. Expands query if gen_key is provided."""
+    def bm25_search(args, topics, searcher, qrels, gen_key=None, doc_cache=None, journal=None):
+        """
+        Runs BM25. Expands query if gen_key is provided.
+        expansion='repeat' はクエリ文字列を times 回繰り返して連結した文字列で検索する (従来の方式)。
+        expansion='weighted' は同じ重みの語の bag を1回の解析で作り、ブースト付きのクエリで検索する。
+        journal (src.journal.StageLog) を渡すと完了済みのクエリは検索し直さない。
+        """
+        weighted = args.expansion == 'weighted'
+        analyzer = SparseSearcher.get_analyzer() if weighted else None
         for key in topics:
             query = topics[key]['title']
+            gen_refs, times = [], 1
             
             # クエリ拡張
             if gen_key and gen_key in topics[key]:
@@ -68,54 +115,193 @@ class SparseSearcher:
                     times = max(1, (len(gen_text)//max(1, len(query)))//max(1, args.adaptive_times))
                 else:
                     times = 1
-                topics[key]['enhanced_query'] = (query + ' ')*times + gen_text
-            else:
+                if not weighted:
+                    topics[key]['enhanced_query'] = (query + ' ')*times + gen_text
+            elif not weighted:
                 # 拡張なし
                 topics[key]['enhanced_query'] = query
 
+            if weighted:
+                topics[key]['weighted_query'] = SparseSearcher.weighted_terms(
+                    analyzer, query, gen_refs, times, args.max_terms
+                )
+
         # 検索実行
         logging.info(f"Running BM25 search...")
-        rank_results = SparseSearcher._run_pyserini_search(topics, searcher, gen_key, args.topk, use_enhanced_query=(gen_key is not None))
+        rank_results = SparseSearcher._run_pyserini_search(
+            topics, searcher, gen_key, args.topk, use_enhanced_query=(gen_key is not None),
+            threads=args.bm25_threads, doc_cache=doc_cache, journal=journal
+        )
         return rank_results
 
     @staticmethod
-    def _run_pyserini_search(topics, searcher, gen_key, k=100, use_enhanced_query=False):
-        ranks = []
-        for qid, topic in tqdm(topics.items(), desc="BM25 Search"):
-            query_text = topic['enhanced_query'] if use_enhanced_query else topic['title']
-            
-            try:
-                hits = searcher.search(query_text, k=k)
-            except Exception as e:
-                logging.error(f"Search failed for qid {qid}: {e}")
-                hits = []
+    def get_analyzer():
+        """LuceneSearcher の既定と同じ解析器 (Porter ステミング + ストップワード除去)。"""
+        from pyserini.analysis import Analyzer, get_lucene_analyzer
+        return Analyzer(get_lucene_analyzer())
 
-            rank_details = {'query': topic['title'], 'qid': qid, 'hits': []}
-            
-            # 生成テキストを結果JSONに保持（後続のRerankerで使うため）
-            if gen_key and gen_key in topic:
-                rank_details[gen_key] = topic[gen_key]
+    @staticmethod
+    def weighted_terms(analyzer, query, gen_refs, times=1, max_terms=0):
+        """
+        (query + ' ')*times + ' '.join(gen_refs) を解析したときと同じ重み
+        (= クエリ中の出現数 x times + 疑似参照文中の出現数) を持つ [(語, 重み), ...] を重み順に返す。
+        Anserini は文字列クエリの語も出現数でブーストした TermQuery にまとめるので、
+        全語を使えば repeat と同じスコアになる。max_terms > 0 なら上位 max_terms 語に切り詰める。
+        """
+        weights = Counter()
+        for term in analyzer.analyze(query):
+            weights[term] += times
+        for ref in gen_refs:
+            weights.update(analyzer.analyze(ref))
+        terms = sorted(weights.items(), key=lambda x: (-x[1], x[0]))
+        limit = min(max_terms, MAX_CLAUSES) if max_terms and max_terms > 0 else MAX_CLAUSES
+        return terms[:limit]
+
+    @staticmethod
+    def _boosted_query(terms, field='contents'):
+        """[(語, 重み), ...] から BoostQuery(TermQuery) の OR (BooleanQuery) を作る。語は解析済みのものを使う。"""
+        from pyserini.pyclass import autoclass
+        JTerm = autoclass('org.apache.lucene.index.Term')
+        JTermQuery = autoclass('org.apache.lucene.search.TermQuery')
+        JBoostQuery = autoclass('org.apache.lucene.search.BoostQuery')
+        JBooleanQueryBuilder = autoclass('org.apache.lucene.search.BooleanQuery$Builder')
+        should = autoclass('org.apache.lucene.search.BooleanClause$Occur').SHOULD
+        builder = JBooleanQueryBuilder()
+        for term, weight in terms:
+            builder.add(JBoostQuery(JTermQuery(JTerm(field, term)), float(weight)), should)
+        return builder.build()
+
+    @staticmethod
+    def _search_one(searcher, qid, query_text, k):
+        try:
+            return searcher.search(query_text, k=k)
+        except Exception as e:
+            logging.error(f"Search failed for qid {qid}: {e}")
+            return []
 
-            for rank, hit in enumerate(hits, start=1):
-                # Raw doc content extraction
-                raw = searcher.doc(hit.docid).raw()
+    @staticmethod
+    def _search_hits(searcher, qids, queries, k=100, threads=1, batch_size=64):
+        """
+        全クエリを検索して {qid: hits} を返す。threads > 1 なら Lucene のマルチスレッド
+        batch_search に batch_size 件ずつ投げる。バッチ全体が失敗した場合はそのバッチだけ
+        1件ずつ検索し直し、失敗したクエリは空の結果にする。
+        """
+        results = {}
+        if PROFILER.enabled:
+            for query_text in queries:
+                PROFILER.sample('bm25_query_terms', len(query_text.split()))
+        if threads <= 1:
+            for qid, query_text in tqdm(zip(qids, queries), total=len(qids), desc="BM25 Search"):
+                start = time.perf_counter()
+                results[qid] = SparseSearcher._search_one(searcher, qid, query_text, k)
+                PROFILER.complete('bm25_query', start, time.perf_counter() - start, 'bm25', qid=qid)
+            return results
+
+        with tqdm(total=len(qids), desc="BM25 Search") as pbar:
+            for start in range(0, len(qids), batch_size):
+                batch_qids = qids[start:start + batch_size]
+                batch_queries = queries[start:start + batch_size]
+                batch_start = time.perf_counter()
                 try:
-                    if isinstance(raw, bytes): raw = raw.decode('utf-8')
-                    content = json.loads(raw)
-                    text_content = content.get('text', content.get('contents', ''))
-                    if 'title' in content:
-                        text_content = f"Title: {content['title']} Content: {text_content}"
-                except:
-                    text_content = "" # Fallback
-                
-                text_content = ' '.join(text_content.split())
-                
-                rank_details['hits'].append({
-                    'content': text_content,
-                    'qid': qid,
-                    'docid': hit.docid,
-                    'rank': rank,
-                    'score': hit.score
-                })
-            ranks.append(rank_details)
+                    results.update(searcher.batch_search(batch_queries, batch_qids, k=k, threads=threads))
+                except Exception as e:
+                    logging.warning(f"Batch search failed ({e}); retrying {len(batch_qids)} queries one by one")
+                    for qid, query_text in zip(batch_qids, batch_queries):
+                        results[qid] = SparseSearcher._search_one(searcher, qid, query_text, k)
+                elapsed = time.perf_counter() - batch_start
+                PROFILER.complete('bm25_batch', batch_start, elapsed, 'bm25', queries=len(batch_qids))
+                # バッチ内のクエリは並列に処理されるため、1クエリあたりは均等割りの値
+                PROFILER.sample('bm25_query_sec', elapsed / len(batch_qids))
+                pbar.update(len(batch_qids))
+        return results
+
+    @staticmethod
+    def _search_weighted(searcher, qids, weighted_queries, k=100, threads=1):
+        """
+        ブースト付きクエリで全クエリを検索して {qid: hits} を返す。
+        batch_search は文字列クエリしか受け付けないため、threads 本のスレッドで search を呼ぶ。
+        """
+        if PROFILER.enabled:
+            for terms in weighted_queries:
+                PROFILER.sample('bm25_query_terms', len(terms))
+        todo = queue.Queue()
+        for item in zip(qids, weighted_queries):
+            todo.put(item)
+        results = {}
+        pbar = tqdm(total=len(qids), desc="BM25 Search (weighted)")
+
+        def worker():
+            try:
+                while True:
+                    try:
+                        qid, terms = todo.get_nowait()
+                    except queue.Empty:
+                        return
+                    start = time.perf_counter()
+                    hits = SparseSearcher._search_one(searcher, qid, SparseSearcher._boosted_query(terms), k)
+                    PROFILER.complete('bm25_query', start, time.perf_counter() - start, 'bm25', qid=qid)
+                    results[qid] = hits
+                    pbar.update(1)
+            finally:
+                if threading.current_thread() is not threading.main_thread():
+                    docstore.detach_jvm()
+
+        workers = [threading.Thread(target=worker, name=f"bm25-{i}") for i in range(max(1, threads) - 1)]
+        for t in workers:
+            t.start()
+        worker()
+        for t in workers:
+            t.join()
+        pbar.close()
+        return results
+
+    @staticmethod
+    def _run_pyserini_search(topics, searcher, gen_key, k=100, use_enhanced_query=False, threads=1, doc_cache=None,
+                             journal=None):
+        """
+        journal (StageLog) を渡すと、記録済みのクエリは検索せずに読み出し、残りを JOURNAL_CHUNK 件ずつ
+        検索して結果 (docid とスコア) を追記する。本文は記録せず、文書キャッシュから引き直す。
+        記録は検索したクエリ (疑似参照文で拡張したもの) ごとなので、生成し直したクエリは検索し直す。
+        """
+        digests = {
+            str(qid): input_digest(topic.get('weighted_query') or
+                                   (topic['enhanced_query'] if use_enhanced_query else topic['title']))
+            for qid, topic in topics.items()
+        } if journal is not None else {}
+        done = journal.load(digests) if journal is not None else {}
+        hit_lists = {qid: (out['docids'], out['scores']) for qid, out in done.items()}
+        todo = [qid for qid in topics if str(qid) not in done]
+        if done:
+            logging.info(f"Resuming BM25: {len(topics) - len(todo)}/{len(topics)} queries already journaled")
+        chunk_size = JOURNAL_CHUNK if journal is not None else max(1, len(todo))
+        for start in range(0, len(todo), chunk_size):
+            chunk = {qid: topics[qid] for qid in todo[start:start + chunk_size]}
+            # batch_search は文字列の qid を要求する
+            qids = [str(qid) for qid in chunk]
+            if all('weighted_query' in topic for topic in chunk.values()):
+                weighted_queries = [topic['weighted_query'] for topic in chunk.values()]
+                all_hits = SparseSearcher._search_weighted(searcher, qids, weighted_queries, k, threads)
+            else:
+                queries = [topic['enhanced_query'] if use_enhanced_query else topic['title'] for topic in chunk.values()]
+                all_hits = SparseSearcher._search_hits(searcher, qids, queries, k, threads)
+            chunk_lists = {qid: ([hit.docid for hit in hits], [hit.score for hit in hits]) for qid, hits in all_hits.items()}
+            hit_lists.update(chunk_lists)
+            if journal is not None:
+                journal.put_many({qid: {'docids': d, 'scores': sc} for qid, (d, sc) in chunk_lists.items()}, digests)
+
+        # 全クエリのヒット文書の本文をまとめて取得 (同じ docid は1回だけ)
+        if doc_cache is None:
+            doc_cache = docstore.DocTextCache(searcher, index_name='', threads=threads)
+        docids = list(dict.fromkeys(docid for docids_, _ in hit_lists.values() for docid in docids_))
+        with PROFILER.span('doc_fetch', 'bm25', docs=len(docids)):
+            doc_texts = dict(zip(docids, doc_cache.get_many(docids)))
+
+        # 本文は DocTable に1回だけ持ち、クエリごとには文書の行番号とスコアの配列だけを持つ
+        table = DocTable()
+        ranks = []
+        for qid, topic in topics.items():
+            docids_, scores = hit_lists.get(str(qid), ([], []))
+            # 生成テキストを結果に保持（後続のRerankerで使うため）
+            extra = {gen_key: topic[gen_key]} if gen_key and gen_key in topic else {}
+            ranks.append(build_query_hits(table, qid, topic['title'], docids_, scores, doc_texts, extra))
         return ranks
\ No newline at end of file
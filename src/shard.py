@@ -0,0 +1,239 @@
+import os
+import time
+import logging
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Tuple
+from src import benchmark, docstore, journal
+from src.hits import DocTable, QueryHits
+from src.profiler import PROFILER
+
+# ワーカープロセスごとに1回だけ作るモデル (LLM クライアント / エンコーダ)
+_STATE: Dict[str, Any] = {}
+
+
+def split_topics(topics: Dict[Any, Dict], n_shards: int) -> List[Dict[Any, Dict]]:
+    """トピックを元の順序のまま連続した n_shards 個の区間に分ける (結合すると元の順序に戻る)。"""
+    keys = list(topics)
+    n_shards = max(1, min(n_shards, len(keys)))
+    bounds = [len(keys) * i // n_shards for i in range(n_shards + 1)]
+    return [{k: topics[k] for k in keys[bounds[i]:bounds[i + 1]]} for i in range(n_shards)]
+
+
+def merge_hits(shards: List[List[QueryHits]]) -> List[QueryHits]:
+    """シャードごとの結果を順に連結し、文書本文は1つの DocTable にまとめ直す。"""
+    table, merged = DocTable(), []
+    for hits in shards:
+        for item in hits:
+            rows = np.fromiter((table.intern(item.table.docids[r], item.table.texts[r]) for r in item.rows.tolist()),
+                               dtype=np.int32, count=len(item.rows))
+            merged.append(QueryHits(item.qid, item.query, rows, item.scores, table, item.extra))
+    return merged
+
+
+def _init_worker(args, n_shards):
+    """ProcessPoolExecutor の initializer。torch はエンコーダを使うときだけ読み込む (_retriever)。"""
+    logging.basicConfig(level=logging.INFO, format=f'%(asctime)s [shard pid={os.getpid()}] %(message)s', force=True)
+    _STATE['args'] = args
+    _STATE['n_shards'] = n_shards
+    # 区間とサンプルはシャードの結果と一緒に親プロセスへ返し、1つの trace にまとめる
+    if args.profile:
+        PROFILER.enable()
+
+
+def _generator(args):
+    if 'generator' not in _STATE:
+        from src.generator import LLMGenerator
+        _STATE['generator'] = LLMGenerator(
+            args.llm,
+            cache_path=None if args.no_gen_cache else args.gen_cache,
+            workers=args.gen_workers,
+            tokens_per_minute=max(1, args.tpm_limit // max(1, args.shards)) if args.tpm_limit else args.tpm_limit,
+            base_url=args.openai_base_url,
+            batch_size=args.gen_batch_size,
+            prefix_cache=not args.no_prefix_cache
+        )
+    return _STATE['generator']
+
+
+def _retriever(args):
+    if 'retriever' not in _STATE:
+        import torch
+        from src.retriever import NeuralRetriever
+        # CPU スレッドはシャード数で分け合う
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // _STATE['n_shards']))
+        _STATE['retriever'] = NeuralRetriever(
+            model_name=args.rank_model, mode=args.mode,
+            emb_cache=None if args.no_emb_cache else args.emb_cache,
+            max_batch_tokens=args.max_batch_tokens,
+            inference=args.inference
+        )
+    return _STATE['retriever']
+
+
+def _reranker(args):
+    """--cascade_model があれば 軽いエンコーダ -> --rank_model のカスケード。"""
+    if not args.cascade_model:
+        return _retriever(args)
+    if 'cascade' not in _STATE:
+        from src.retriever import CascadeRetriever, NeuralRetriever
+        final = _retriever(args)
+        first = NeuralRetriever(
+            model_name=args.cascade_model, mode=args.mode,
+            emb_cache=None if args.no_emb_cache else args.emb_cache,
+            max_batch_tokens=args.max_batch_tokens,
+            inference=args.inference
+        )
+        _STATE['cascade'] = CascadeRetriever(first, final, args.cascade_m)
+    return _STATE['cascade']
+
+
+def _run_shard(dataset: str, shard_id: int, topics: Dict[Any, Dict]) -> Tuple[int, List[QueryHits], Dict, Dict, Dict]:
+    """_shard_stages の結果に、このワーカーの --profile の記録 (PROFILER.export) を付けて返す。"""
+    with PROFILER.span('shard', dataset=dataset, shard=shard_id, queries=len(topics)):
+        result = _shard_stages(dataset, shard_id, topics)
+    return result + (PROFILER.export(),)
+
+
+def _shard_stages(dataset: str, shard_id: int, topics: Dict[Any, Dict]) -> Tuple[int, List[QueryHits], Dict, Dict]:
+    """
+    ワーカープロセスで1シャード分の 生成 -> BM25 -> (rerank) を実行する。
+    LuceneSearcher / 文書キャッシュ / エンコーダはプロセスごとに持つ (生成と埋め込みのキャッシュはプロセス間で共有)。
+    """
+    from src.prompts import PromptManager
+    from src.searcher import SparseSearcher
+
+    args = _STATE['args']
+    timings = {}
+    start = time.perf_counter()
+    gen_key = None
+    if args.doc_gen > 0:
+        gen_key = SparseSearcher.gen_key_for(args.llm)
+        SparseSearcher.add_pseudo_docs(topics, _generator(args), PromptManager, gen_key, args.doc_gen)
+    index_name = benchmark.THE_INDEX[dataset]
+    doc_cache = docstore.get_doc_cache(
+        index_name, capacity=args.doc_cache_size,
+        disk_path=None if args.no_doc_cache else args.doc_cache,
+        threads=args.bm25_threads
+    )
+    if args.irmode == 'mugidense':
+        # 埋め込みと IVF 索引はディスク上のものを各ワーカーが memmap で共有する
+        from src import ann
+        bm25_results = ann.dense_search(args, topics, _retriever(args), docstore.get_searcher(index_name), index_name,
+                                        gen_key, doc_cache)
+        timings['search_sec'] = time.perf_counter() - start
+        rerank_result = {item.qid: list(zip(item.docids(), item.scores.tolist())) for item in bm25_results if item.qid}
+        return shard_id, bm25_results, rerank_result, timings
+    # シャードが失敗して投げ直された場合も、ジャーナルに記録済みのクエリはやり直さない
+    bm25_results = SparseSearcher.bm25_search(args, topics, docstore.get_searcher(index_name), None, gen_key, doc_cache,
+                                              journal=journal.open_stage(args, 'bm25', dataset))
+    timings['search_sec'] = time.perf_counter() - start
+
+    rerank_result = None
+    if args.irmode in ['mugirerank', 'mugipipeline']:
+        start = time.perf_counter()
+        retriever = _reranker(args)
+        rerank_result = journal.resume_rerank(
+            retriever, bm25_results, gen_key, journal.open_stage(args, 'rerank', dataset),
+            topk=args.dense_topk, use_enhanced_query=True, index_name=index_name,
+            **({'stats': timings} if args.cascade_model else {})
+        )
+        timings['rerank_sec'] = time.perf_counter() - start
+    return shard_id, bm25_results, rerank_result, timings
+
+
+class ShardRunner:
+    """
+    トピックを --shards 個に分けてワーカープロセスで並列に処理する。
+    各ワーカーは自分の LuceneSearcher (JVM) とエンコーダを持つため、GIL と1プロセス1 searcher の制約を受けない。
+    失敗したシャードだけを --shard_retries 回まで投げ直し、結果は常にトピックの順序で結合する。
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.n_shards = max(1, args.shards)
+        self._pool = None
+
+    def _new_pool(self):
+        # JVM (pyjnius) は fork 後に使えないので spawn で起動する
+        return ProcessPoolExecutor(
+            max_workers=self.n_shards, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker, initargs=(self.args, self.n_shards)
+        )
+
+    def run_dataset(self, dataset: str, topics: Dict[Any, Dict]):
+        """(bm25_results, rerank_result または None, timings) を返す。失敗したシャードが残れば例外。"""
+        shards = split_topics(topics, self.n_shards)
+        logging.info(f"[shard] {dataset}: {len(topics)} queries -> {len(shards)} shards")
+        results: Dict[int, Tuple] = {}
+        attempts = {i: 0 for i in range(len(shards))}
+        breaks = 0
+        pending = list(range(len(shards)))
+        start = time.perf_counter()
+        with PROFILER.span('shards', dataset=dataset, shards=len(shards)):
+            while pending:
+                if self._pool is None:
+                    self._pool = self._new_pool()
+                futures = {self._pool.submit(_run_shard, dataset, i, shards[i]): i for i in pending}
+                failed, broken = [], None
+                for future in as_completed(futures):
+                    i = futures[future]
+                    try:
+                        _, bm25_results, rerank_result, timings, profile = future.result()
+                        results[i] = (bm25_results, rerank_result, timings)
+                        PROFILER.merge(profile)
+                    except BrokenProcessPool as e:
+                        # ワーカーが1つ落ちると実行中の全シャードがこの例外になり、どのシャードが原因かは分からない。
+                        # シャードごとの試行回数には数えず、プールが壊れた回数で打ち切る
+                        broken = e
+                        failed.append(i)
+                    except Exception as e:
+                        attempts[i] += 1
+                        logging.warning(f"[shard] {dataset} shard {i} failed (attempt {attempts[i]}): {e!r}")
+                        if attempts[i] > self.args.shard_retries:
+                            raise RuntimeError(f"{dataset} shard {i} failed after {attempts[i]} attempts") from e
+                        failed.append(i)
+                if broken is not None:
+                    # プール全体が使えなくなるので作り直す
+                    self._shutdown_pool()
+                    breaks += 1
+                    logging.warning(f"[shard] {dataset} worker pool broke ({breaks} times); "
+                                    f"resubmitting in-flight shards {sorted(failed)}")
+                    if breaks > self.args.shard_retries:
+                        raise RuntimeError(f"{dataset} worker pool broke {breaks} times") from broken
+                pending = sorted(failed)
+
+        ordered = [results[i] for i in range(len(shards))]
+        bm25_results = merge_hits([r[0] for r in ordered])
+        rerank_result = None
+        if all(r[1] is not None for r in ordered):
+            rerank_result = {}
+            for r in ordered:
+                rerank_result.update(r[1])
+        timings = {'search_sec': time.perf_counter() - start}
+        for key in ('search_sec', 'rerank_sec', 'cascade_first_sec', 'cascade_final_sec'):
+            values = [r[2][key] for r in ordered if key in r[2]]
+            if values:
+                timings[f'shard_{key}_max'] = max(values)
+        for key in ('cascade_first_docs', 'cascade_final_docs'):
+            if any(key in r[2] for r in ordered):
+                timings[key] = sum(r[2].get(key, 0) for r in ordered)
+        return bm25_results, rerank_result, timings
+
+    def _shutdown_pool(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,105 @@
+import os
+import re
+import pickle
+import logging
+import argparse
+import threading
+from typing import Any, Dict
+from src import benchmark
+
+# pyserini の topics / qrels を pickle で手元に保存する場所
+SNAPSHOT_DIR = os.path.join('.', 'exp', 'cache', 'topics')
+SNAPSHOT_VERSION = 1
+
+_LOADED: Dict[tuple, Dict[str, Any]] = {}
+_LOCK = threading.Lock()
+
+
+def topics_name(dataset: str) -> str:
+    """SparseSearcher が使うトピック名 (dl20 だけ pyserini の 'dl20' を使う)。"""
+    return 'dl20' if dataset == 'dl20' else benchmark.THE_TOPICS[dataset]
+
+
+def _path(kind: str, name: str) -> str:
+    return os.path.join(SNAPSHOT_DIR, f"{kind}-{re.sub(r'[^A-Za-z0-9._-]+', '_', name)}.pkl")
+
+
+def _build(kind: str, name: str) -> Dict[str, Any]:
+    # pyserini (と JVM) はスナップショットがないときだけ読み込む
+    if kind == 'topics':
+        from pyserini.search import get_topics
+        return {'topics': get_topics(name)}
+    from pyserini.search import get_qrels, get_qrels_file
+    return {'qrels': get_qrels(name), 'file': get_qrels_file(name)}
+
+
+def _load(kind: str, name: str, refresh: bool = False) -> Dict[str, Any]:
+    """プロセス内 -> ローカルの pickle -> pyserini の順に探し、pyserini から読んだ場合は保存する。"""
+    key = (kind, name)
+    with _LOCK:
+        if key in _LOADED and not refresh:
+            return _LOADED[key]
+        path = _path(kind, name)
+        data = None
+        if os.path.exists(path) and not refresh:
+            try:
+                with open(path, 'rb') as f:
+                    data = pickle.load(f)
+                if data.get('version') != SNAPSHOT_VERSION:
+                    data = None
+            except Exception as e:
+                logging.warning(f"Ignoring broken snapshot {path}: {e}")
+                data = None
+        if data is None:
+            data = dict(_build(kind, name), version=SNAPSHOT_VERSION)
+            os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+            # 並列に走る他のプロセスが書きかけのファイルを読まないよう、一時ファイルから置き換える
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        _LOADED[key] = data
+        return data
+
+
+def get_topics(name: str) -> Dict[Any, Dict[str, Any]]:
+    """pyserini.search.get_topics と同じ {qid: {'title': ...}}。呼び出し側が書き換えてよいようにトピックはコピーを返す。"""
+    return {qid: dict(topic) for qid, topic in _load('topics', name)['topics'].items()}
+
+
+def get_qrels(name: str) -> Dict[Any, Dict[str, int]]:
+    """pyserini.search.get_qrels と同じ {qid: {docid: rel}} (共有しているので書き換えないこと)。"""
+    return _load('qrels', name)['qrels']
+
+
+def get_qrels_file(name: str) -> str:
+    """qrels ファイル (pyserini のキャッシュ) のパス。ファイルが消えていれば pyserini から取り直す。"""
+    data = _load('qrels', name)
+    if not data.get('file') or not os.path.exists(data['file']):
+        data = _load('qrels', name, refresh=True)
+    return data['file']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build local topics/qrels snapshots for fast startup")
+    parser.add_argument('datasets', nargs='*', default=list(benchmark.THE_TOPICS),
+                        help='Datasets in benchmark.THE_TOPICS (default: all)')
+    parser.add_argument('--refresh', action='store_true', help='Rebuild snapshots from pyserini')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    for dataset in args.datasets:
+        try:
+            targets = dict.fromkeys([('topics', topics_name(dataset)), ('topics', benchmark.THE_TOPICS[dataset]),
+                                     ('qrels', benchmark.THE_TOPICS[dataset])])
+            for kind, name in targets:
+                _load(kind, name, refresh=args.refresh)
+        except Exception as e:
+            logging.error(f"Failed to snapshot {dataset}: {e}")
+            continue
+        logging.info(f"{dataset}: {len(get_topics(topics_name(dataset)))} topics, "
+                     f"{len(get_qrels(benchmark.THE_TOPICS[dataset]))} judged queries")
+
+
+if __name__ == "__main__":
+    main()
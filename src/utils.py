@@ -1,9 +1,10 @@
 import os
 import json
 import logging
-from typing import List, Dict, Any
-from pyserini.search import get_topics
-from src import benchmark
+from typing import List, Dict, Any, Tuple, Iterator
+from src import benchmark, snapshot
+from src.resultio import iter_results
+from src.hits import QueryHits, to_query_hits
 
 def load_json(path):
     if not os.path.exists(os.path.dirname(path)):
@@ -19,84 +20,120 @@ def dump_json(data, path):
     with open(path, 'w', encoding='utf-8') as f:
         json.dump(data, f, indent=4, ensure_ascii=False)
 
+class RunWriter:
+    """
+    TREC RUN形式 (qid Q0 docid rank score tag) をクエリごとに逐次書き出す。
+    """
+
+    def __init__(self, run_path: str, tag: str = None):
+        if os.path.dirname(run_path):
+            os.makedirs(os.path.dirname(run_path), exist_ok=True)
+        self.run_path = run_path
+        # runファイルのタグ名（ファイル名から拡張子を除いたもの）
+        self.tag = tag or os.path.splitext(os.path.basename(run_path))[0]
+        self.lines = 0
+        self._f = open(run_path, 'w', encoding='utf-8')
+
+    def write(self, qid, ranked: List[Tuple[str, float]]):
+        records = [f"{qid} Q0 {docid} {rank} {score} {self.tag}\n"
+                   for rank, (docid, score) in enumerate(ranked, start=1)]
+        self._f.writelines(records)
+        self._f.flush()
+        self.lines += len(records)
+
+    def close(self):
+        if not self._f.closed:
+            self._f.close()
+            logging.info(f"Wrote RUN: {self.run_path} ({self.lines} lines)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 def convert_json_to_run(json_path: str, run_path: str, dataset: str):
     """
-    JSON結果ファイルをTREC RUN形式に変換して保存する。
+    結果ファイル (JSON Lines / 従来の JSON) をTREC RUN形式に変換して保存する。
+    JSON Lines はクエリごとに読みながら書き出す (本文は読まない)。
     """
     if not os.path.exists(os.path.dirname(run_path)):
         os.makedirs(os.path.dirname(run_path), exist_ok=True)
 
+    lines = 0
+    # runファイルのタグ名（ファイル名から拡張子を除いたもの）
+    tag = os.path.splitext(os.path.basename(run_path))[0]
+    q2id = None
+    with open(run_path, "w", encoding="utf-8") as out:
+        for entry in iter_results(json_path, with_content=False):
+            qtext = entry.get('query', '').strip()
+            # QIDの特定: 結果JSONにqidが含まれていればそれを優先、なければテキストマッチ
+            qid = str(entry.get('qid') or (entry.get('hits') or [{}])[0].get('qid', ''))
+            if not qid:
+                if q2id is None:
+                    q2id = _query_to_qid(dataset)
+                qid = q2id.get(qtext)
+
+            if not qid:
+                continue
+
+            records = []
+            for rank, hit in enumerate(entry.get('hits', []), start=1):
+                docid = hit.get('docid')
+                score = hit.get('score', 0.0)
+                if docid:
+                    records.append(f"{qid} Q0 {docid} {rank} {score} {tag}\n")
+            out.writelines(records)
+            lines += len(records)
+
+    logging.info(f"Converted to RUN: {run_path} ({lines} lines)")
+
+def _query_to_qid(dataset: str) -> Dict[str, str]:
+    """クエリ文字列 -> QID のマッピングを作成 (qid を持たない古いJSON用)"""
     # Dataset名からTopic名を取得 (benchmark.pyを利用)
     topic_key = benchmark.THE_TOPICS.get(dataset)
     if not topic_key:
         logging.warning(f"Unknown dataset: {dataset}. Conversion might fail if queries don't match.")
-        return
-
-    # クエリ文字列 -> QID のマッピングを作成
-    topics = get_topics(topic_key)
+        return {}
+    topics = snapshot.get_topics(topic_key)
     q2id = {}
     for qid, obj in topics.items():
         qtext = obj.get("title") or obj.get("query") or str(obj)
         q2id[qtext.strip()] = str(qid)
-
-    with open(json_path, encoding="utf-8") as f:
-        data = json.load(f)
-
-    records = []
-    # runファイルのタグ名（ファイル名から拡張子を除いたもの）
-    tag = os.path.splitext(os.path.basename(run_path))[0]
-
-    for entry in data:
-        qtext = entry.get('query', '').strip()
-        # QIDの特定: 結果JSONにqidが含まれていればそれを優先、なければテキストマッチ
-        qid = str(entry.get('hits', [{}])[0].get('qid', ''))
-        if not qid:
-            qid = q2id.get(qtext)
-        
-        if not qid:
-            continue
-
-        for rank, hit in enumerate(entry.get('hits', []), start=1):
-            docid = hit.get('docid')
-            score = hit.get('score', 0.0)
-            if docid:
-                records.append(f"{qid} Q0 {docid} {rank} {score} {tag}\n")
-
-    with open(run_path, "w", encoding="utf-8") as f:
-        f.writelines(records)
-    
-    logging.info(f"Converted to RUN: {run_path} ({len(records)} lines)")
+    return q2id
 
 # ... (以下、前回の normalize_rerank_to_bm25_json 等はそのまま残す) ...
-def _index_bm25_by_qid(bm25_rank_results: Any) -> Dict[str, Dict[str, Any]]:
-    # ... (前回のコードと同じ) ...
-    qmap: Dict[str, Dict[str, Any]] = {}
+def _index_bm25_by_qid(bm25_rank_results: Any) -> Dict[str, QueryHits]:
+    """BM25 の結果 (QueryHits または従来の dict) を qid (文字列) で引けるようにする。ヒットのないクエリは除く。"""
     results = bm25_rank_results if isinstance(bm25_rank_results, list) else [bm25_rank_results]
-    for entry in results:
-        hits = entry.get('hits', [])
-        if not hits: continue
-        qid = str(hits[0].get('qid'))
-        if not qid: continue
-        hits_by_docid = {str(h.get('docid')): h for h in hits}
-        extra = {k: v for k, v in entry.items() if k not in ('hits',)}
-        qmap[qid] = {'query': entry.get('query', ''), 'extra': extra, 'hits_by_docid': hits_by_docid}
-    return qmap
-
-def normalize_rerank_to_bm25_json(rerank_result: Any, bm25_rank_results: Any) -> List[Dict[str, Any]]:
-    # ... (前回のコードと同じ) ...
-    out: List[Dict[str, Any]] = []
+    return {str(item.qid): item for item in to_query_hits(results) if len(item) and item.qid is not None}
+
+def normalize_rerank_to_bm25_json(rerank_result: Any, bm25_rank_results: Any, topk: int = 10) -> List[Dict[str, Any]]:
+    """
+    rerank の結果 ({qid: [docid, ...]} または {qid: [(docid, score), ...]}) を BM25 と同じ JSON 形式にする。
+    score があれば密スコアを、なければ BM25 スコアを入れる。各クエリ上位 topk 件のみ残す。
+    """
+    return list(iter_normalized_rerank(rerank_result, bm25_rank_results, topk))
+
+def iter_normalized_rerank(rerank_result: Any, bm25_rank_results: Any, topk: int = 10) -> Iterator[Dict[str, Any]]:
+    """normalize_rerank_to_bm25_json と同じエントリを1クエリずつ返す (ResultWriter への逐次書き出し用)。"""
     qmap = _index_bm25_by_qid(bm25_rank_results)
     if isinstance(rerank_result, dict):
-        for qid, docids in rerank_result.items():
+        for qid, ranked in rerank_result.items():
             qid = str(qid)
-            base = qmap.get(qid, {'query': '', 'extra': {}, 'hits_by_docid': {}})
-            entry: Dict[str, Any] = {'query': base['query'], 'hits': []}
-            entry.update(base['extra']) 
-            for rnk, docid in enumerate(docids, start=1):
-                src = base['hits_by_docid'].get(str(docid), {})
+            base = qmap.get(qid)
+            entry: Dict[str, Any] = {'query': '', 'hits': []}
+            bm25_scores, texts, rows = {}, [], None
+            if base is not None:
+                entry.update({'query': base.query, 'qid': base.qid}, **base.extra)
+                bm25_scores = base.score_by_docid()
+                texts, rows = base.table.texts, base.table.row
+            for rnk, doc in enumerate(ranked[:topk], start=1):
+                docid, score = doc if isinstance(doc, (tuple, list)) else (doc, None)
+                in_bm25 = str(docid) in bm25_scores
                 entry['hits'].append({
                     'qid': qid, 'docid': docid, 'rank': rnk,
-                    'score': src.get('score', 0.0), 'content': src.get('content', '')
+                    'score': bm25_scores.get(str(docid), 0.0) if score is None else score,
+                    'content': texts[rows(str(docid))] if in_bm25 else ''
                 })
-            out.append(entry)
-    return out
\ No newline at end of file
+            yield entry
\ No newline at end of file
@@ -0,0 +1,261 @@
+import os
+import copy
+import json
+import time
+import hashlib
+import logging
+import argparse
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from src.prompts import PromptManager
+from src.searcher import SparseSearcher
+from src import benchmark, docstore, journal
+from src.profiler import PROFILER
+import config
+import main as pipeline
+
+
+logging.getLogger('httpx').setLevel(logging.WARNING)
+logging.getLogger('httpcore').setLevel(logging.WARNING)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s',force=True)
+
+# BM25 の結果に影響するパラメータ (疑似参照文は別途 llm と使用件数で区別する)
+BM25_PARAMS = ('topk', 'repeat_times', 'adaptive_times', 'expansion', 'max_terms')
+
+
+def expand_grid(spec):
+    """
+    グリッド指定 (JSON) を実験設定のリストに展開する。
+    {"datasets": [...], "fixed": {"irmode": ...}, "grid": {"llm": [...], "doc_gen": [...], ...}}
+    """
+    base = config.parse_args([])
+    for key, value in spec.get('fixed', {}).items():
+        setattr(base, key, value)
+    grid = spec.get('grid', {})
+    names = list(grid)
+    configs = []
+    for values in itertools.product(*(grid[n] for n in names)):
+        cfg = copy.copy(base)
+        for name, value in zip(names, values):
+            setattr(cfg, name, value)
+        varied = json.dumps(dict(zip(names, values)), sort_keys=True, default=str)
+        # 同じ (dataset, llm, mode, doc_gen) でも他の値が違えば別ファイルにする
+        cfg.run_suffix = f"_{hashlib.sha1(varied.encode()).hexdigest()[:8]}" if names else ''
+        configs.append(cfg)
+    return configs
+
+
+def gen_stage_key(cfg, dataset):
+    """生成は (dataset, llm) だけで決まる (doc_gen の違いは多い方を生成して先頭を使う)。"""
+    if cfg.doc_gen <= 0:
+        return None
+    return ('gen', dataset, cfg.test, cfg.llm)
+
+
+def bm25_stage_key(cfg, dataset):
+    """BM25 は拡張に使う疑似参照文 (llm, 先頭 min(doc_gen, article_num) 件) と BM25 設定で決まる。"""
+    params = tuple(getattr(cfg, p) for p in BM25_PARAMS)
+    if cfg.doc_gen <= 0:
+        return ('bm25', dataset, cfg.test, params[0], cfg.expansion, cfg.max_terms)
+    return ('bm25', dataset, cfg.test, params, cfg.llm, min(cfg.doc_gen, cfg.article_num))
+
+
+def plan(configs, datasets):
+    """(config, dataset) ごとのジョブと、ユニークな stage (生成は必要なサンプル数も) を返す。"""
+    jobs, gen_counts, bm25_keys = [], {}, set()
+    for cfg in configs:
+        for dataset in datasets:
+            gen_key, bm25_key = gen_stage_key(cfg, dataset), bm25_stage_key(cfg, dataset)
+            if gen_key:
+                gen_counts[gen_key] = max(gen_counts.get(gen_key, 0), cfg.doc_gen)
+            bm25_keys.add(bm25_key)
+            jobs.append((cfg, dataset, gen_key, bm25_key))
+    return jobs, gen_counts, bm25_keys
+
+
+class StageRunner:
+    """stage key ごとに一度だけ実行し、結果 (Future) を全ての設定で共有する。"""
+
+    def __init__(self, gen_counts, gen_workers, bm25_workers, rerank_workers):
+        self.gen_counts = gen_counts
+        self.pools = {
+            'gen': ThreadPoolExecutor(max_workers=gen_workers, thread_name_prefix='gen'),
+            'bm25': ThreadPoolExecutor(max_workers=bm25_workers, thread_name_prefix='bm25'),
+            'rerank': ThreadPoolExecutor(max_workers=rerank_workers, thread_name_prefix='rerank'),
+        }
+        self._futures = {}
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def submit(self, pool, key, fn, *args):
+        with self._lock:
+            if key not in self._futures:
+                self._futures[key] = self.pools[pool].submit(fn, *args)
+            return self._futures[key]
+
+    def model(self, key, factory):
+        """LLM / エンコーダ / トピックは key ごとに1回だけロードする。"""
+        with self._lock:
+            if key not in self._models:
+                self._models[key] = threading.Lock(), {}
+            lock, holder = self._models[key]
+        with lock:
+            if 'model' not in holder:
+                holder['model'] = factory()
+            return holder['model']
+
+    def shutdown(self):
+        for pool in self.pools.values():
+            pool.shutdown(wait=True)
+
+    # ---- stages ----
+    def topics(self, cfg, dataset):
+        # プール内のジョブから呼ばれるので、プールには投げずその場で1回だけ読み込む
+        return self.model(('topics', dataset, cfg.test), lambda: SparseSearcher.get_data_pyserini(dataset, cfg.test))
+
+    def generation(self, cfg, dataset, gen_key):
+        """{qid: [疑似参照文, ...]} (この llm で必要な最大件数)"""
+        def run():
+            from src.generator import LLMGenerator
+            _, topics, _ = self.topics(cfg, dataset)
+            generator = self.model(('llm', cfg.llm), lambda: LLMGenerator(
+                cfg.llm,
+                cache_path=None if cfg.no_gen_cache else cfg.gen_cache,
+                workers=cfg.gen_workers,
+                tokens_per_minute=cfg.tpm_limit,
+                base_url=cfg.openai_base_url,
+                batch_size=cfg.gen_batch_size,
+                prefix_cache=not cfg.no_prefix_cache
+            ))
+            topics = {qid: dict(topic) for qid, topic in topics.items()}
+            key = SparseSearcher.gen_key_for(cfg.llm)
+            logging.info(f"[sweep] Generating {self.gen_counts[gen_key]} pseudo-docs for {dataset} using {cfg.llm}")
+            SparseSearcher.add_pseudo_docs(topics, generator, PromptManager, key, self.gen_counts[gen_key])
+            return {qid: topic[key] for qid, topic in topics.items()}
+        return self.submit('gen', gen_key, run)
+
+    def bm25(self, cfg, dataset, gen_key, bm25_key):
+        def run():
+            start = time.perf_counter()
+            searcher, topics, qrels = self.topics(cfg, dataset)
+            topics = {qid: dict(topic) for qid, topic in topics.items()}
+            key = None
+            if gen_key:
+                refs = self.generation(cfg, dataset, gen_key).result()
+                key = SparseSearcher.gen_key_for(cfg.llm)
+                for qid in topics:
+                    topics[qid][key] = refs[qid][:min(cfg.doc_gen, cfg.article_num)]
+            doc_cache = docstore.get_doc_cache(
+                benchmark.THE_INDEX[dataset], capacity=cfg.doc_cache_size,
+                disk_path=None if cfg.no_doc_cache else cfg.doc_cache,
+                threads=cfg.bm25_threads
+            )
+            results = SparseSearcher.bm25_search(cfg, topics, searcher, qrels, key, doc_cache,
+                                                 journal=journal.open_stage(cfg, 'bm25', dataset))
+            return results, time.perf_counter() - start
+        return self.submit('bm25', bm25_key, run)
+
+    def dense(self, cfg, dataset, gen_key, retriever):
+        """--irmode mugidense: BM25 の代わりにコーパス全体から密ベクトル検索する。"""
+        from src import ann
+        start = time.perf_counter()
+        searcher, topics, _ = self.topics(cfg, dataset)
+        topics = {qid: dict(topic) for qid, topic in topics.items()}
+        key = None
+        if gen_key:
+            refs = self.generation(cfg, dataset, gen_key).result()
+            key = SparseSearcher.gen_key_for(cfg.llm)
+            for qid in topics:
+                topics[qid][key] = refs[qid][:cfg.doc_gen]
+        doc_cache = docstore.get_doc_cache(
+            benchmark.THE_INDEX[dataset], capacity=cfg.doc_cache_size,
+            disk_path=None if cfg.no_doc_cache else cfg.doc_cache,
+            threads=cfg.bm25_threads
+        )
+        results = ann.dense_search(cfg, topics, retriever, searcher, benchmark.THE_INDEX[dataset], key, doc_cache)
+        return results, time.perf_counter() - start
+
+    def rerank(self, cfg, dataset, gen_key, bm25_key):
+        def run():
+            if cfg.irmode == 'mugidense':
+                retriever = self.encoder(cfg)
+                results, search_sec = self.dense(cfg, dataset, gen_key, retriever)
+                pipeline.rerank_dataset(dataset, results, retriever, cfg, timings={'search_sec': search_sec})
+                return
+            bm25_results, search_sec = self.bm25(cfg, dataset, gen_key, bm25_key).result()
+            if not bm25_results:
+                logging.warning(f"[sweep] No results found for {dataset}. Skipping.")
+                return
+            # BM25 の結果は共有し、rerank で使う疑似参照文だけこの設定の doc_gen 件に差し替える
+            if gen_key:
+                refs = self.generation(cfg, dataset, gen_key).result()
+                key = SparseSearcher.gen_key_for(cfg.llm)
+                bm25_results = [item.with_extra(**{key: refs.get(item.qid, [])[:cfg.doc_gen]}) for item in bm25_results]
+            pipeline.rerank_dataset(dataset, bm25_results, self.reranker(cfg), cfg, timings={'search_sec': search_sec})
+        return self.submit('rerank', ('rerank', id(cfg), dataset), run)
+
+    def reranker(self, cfg):
+        """--cascade_model があれば、両段のエンコーダを他の設定と共有したままカスケードにする。"""
+        if not cfg.cascade_model:
+            return self.encoder(cfg)
+        from src.retriever import CascadeRetriever
+        return CascadeRetriever(self.encoder(cfg, cfg.cascade_model), self.encoder(cfg), cfg.cascade_m)
+
+    def encoder(self, cfg, model_name=None):
+        from src.retriever import NeuralRetriever
+        model_name = model_name or cfg.rank_model
+        retriever = self.model(('encoder', model_name, cfg.inference), lambda: NeuralRetriever(
+            model_name=model_name, mode=cfg.mode,
+            emb_cache=None if cfg.no_emb_cache else cfg.emb_cache,
+            max_batch_tokens=cfg.max_batch_tokens,
+            inference=cfg.inference
+        ))
+        # mode はクエリ側の組み立てにだけ効くので、モデルを共有したまま設定ごとに切り替える
+        retriever = copy.copy(retriever)
+        retriever.mode = cfg.mode
+        return retriever
+
+
+def run_sweep(spec, gen_workers=2, bm25_workers=2, rerank_workers=1, dry_run=False):
+    datasets = spec.get('datasets', benchmark.DATASETS)
+    configs = expand_grid(spec)
+    jobs, gen_counts, bm25_keys = plan(configs, datasets)
+    logging.info(f"[sweep] {len(configs)} configs x {len(datasets)} datasets = {len(jobs)} jobs | "
+                 f"unique stages: {len(gen_counts)} generation, {len(bm25_keys)} BM25, {len(jobs)} rerank")
+    if dry_run:
+        for cfg, dataset, gen_key, bm25_key in jobs:
+            logging.info(f"  {dataset} llm={cfg.llm} doc_gen={cfg.doc_gen} mode={cfg.mode} rank_model={pipeline.rank_model_label(cfg)} "
+                         f"suffix={cfg.run_suffix} | gen={gen_key} bm25={bm25_key}")
+        return
+
+    if any(cfg.profile for cfg in configs):
+        PROFILER.enable()
+    for cfg, dataset, _, _ in jobs:
+        if cfg.fresh:
+            journal.discard_dataset(cfg, dataset)
+    runner = StageRunner(gen_counts, gen_workers, bm25_workers, rerank_workers)
+    try:
+        futures = [runner.rerank(cfg, dataset, gen_key, bm25_key) for cfg, dataset, gen_key, bm25_key in jobs]
+        for future, (cfg, dataset, _, _) in zip(futures, jobs):
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"[sweep] {dataset} ({cfg.llm}, {cfg.mode}, n{cfg.doc_gen}, {pipeline.rank_model_label(cfg)}) failed: {e}")
+    finally:
+        runner.shutdown()
+        PROFILER.save(os.path.join(configs[0].output_path, 'profiles', f"sweep_{int(time.time())}.trace.json"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gen-QER: parameter sweep with shared stages")
+    parser.add_argument('--spec', type=str, required=True, help='JSON grid spec (datasets / fixed / grid)')
+    parser.add_argument('--gen_parallel', type=int, default=2, help='Generation stages run concurrently')
+    parser.add_argument('--bm25_parallel', type=int, default=2, help='BM25 stages run concurrently')
+    parser.add_argument('--rerank_parallel', type=int, default=1, help='Rerank/eval stages run concurrently')
+    parser.add_argument('--dry_run', action='store_true', help='Only print the planned stages')
+    sweep_args = parser.parse_args()
+
+    with open(sweep_args.spec, encoding='utf-8') as f:
+        spec = json.load(f)
+    run_sweep(spec, sweep_args.gen_parallel, sweep_args.bm25_parallel, sweep_args.rerank_parallel, sweep_args.dry_run)
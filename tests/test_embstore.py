@@ -0,0 +1,19 @@
+import numpy as np
+from src.embstore import EmbeddingStore
+
+
+def test_add_after_writer_died_mid_append(tmp_path):
+    store = EmbeddingStore(str(tmp_path), 'model', 'index')
+    store.add(['k0'], np.zeros((1, 4)))
+    # 別のプロセスがベクトルとキーの途中まで書いて落ちた状態
+    with open(store.vec_path, 'ab') as f:
+        f.write(np.full((1, 4), 9, dtype=np.float32).tobytes())
+    with open(store.key_path, 'ab') as f:
+        f.write(b'partial')
+
+    store.add(['k1'], np.ones((1, 4)))
+    assert np.array_equal(store.vectors(store.lookup(['k1'])), np.ones((1, 4), dtype=np.float32))
+
+    reopened = EmbeddingStore(str(tmp_path), 'model', 'index')
+    assert reopened.keys() == ['k0', 'k1']
+    assert np.array_equal(reopened.vectors(reopened.lookup(['k0', 'k1'])), np.array([[0] * 4, [1] * 4], dtype=np.float32))
@@ -0,0 +1,47 @@
+import pytest
+from src import docstore, resultio
+
+ENTRIES = [
+    {'qid': '1', 'query': 'q1', 'hits': [{'docid': 'd1', 'rank': 1, 'score': 2.0, 'content': 'text one'},
+                                          {'docid': 'd2', 'rank': 2, 'score': 1.0, 'content': 'text two'}]},
+    {'qid': '2', 'query': 'q2', 'hits': [{'docid': 'd2', 'rank': 1, 'score': 3.0, 'content': 'text two'}]},
+]
+
+
+class FakeDocCache:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def get_many(self, docids):
+        return [self.docs.get(d, '') for d in docids]
+
+
+def _write(path, **kwargs):
+    with resultio.ResultWriter(str(path), **kwargs) as writer:
+        for entry in ENTRIES:
+            writer.write(entry)
+
+
+def test_round_trip_without_text_resolves_from_index(tmp_path, monkeypatch):
+    path = tmp_path / 'run.jsonl.gz'
+    _write(path, index_name='msmarco-v1-passage', with_text=False)
+    requested = []
+
+    def get_doc_cache(index_name, *args, **kwargs):
+        requested.append(index_name)
+        return FakeDocCache({'d1': 'text one', 'd2': 'text two'})
+
+    monkeypatch.setattr(docstore, 'get_doc_cache', get_doc_cache)
+    entries = list(resultio.iter_results(str(path), with_content=True))
+    assert requested == ['msmarco-v1-passage']
+    assert [[(h['qid'], h['docid'], h['content']) for h in e['hits']] for e in entries] == [
+        [('1', 'd1', 'text one'), ('1', 'd2', 'text two')], [('2', 'd2', 'text two')]]
+
+
+def test_round_trip_without_text_or_index_raises(tmp_path):
+    path = tmp_path / 'run.jsonl'
+    _write(path, with_text=False)
+    with pytest.raises(ValueError, match='no document text'):
+        list(resultio.iter_results(str(path), with_content=True))
+    assert [h['docid'] for e in resultio.iter_results(str(path), with_content=False) for h in e['hits']] == \
+        ['d1', 'd2', 'd2']